@@ -6,6 +6,7 @@ from ast import literal_eval
 
 from .program import *
 from .passes import PASSES
+from . import snapshot
 
 def lookup_pass(name):
     if name in PASSES:
@@ -44,6 +45,8 @@ def main():
     parser.add_argument('-p', '--run-passes', type=str, default="")
     parser.add_argument('-H', '--list-passes', action='store_true')
     parser.add_argument('-s', '--script', type=str, default="")
+    parser.add_argument('-S', '--snapshot', type=pathlib.Path,
+                        help='start from a program snapshot instead of an image')
     parser.add_argument('image', type=pathlib.Path, nargs="?")
 
     args = parser.parse_args()
@@ -54,7 +57,14 @@ def main():
             print(f.__doc__, file=sys.stderr)
         sys.exit(0)
 
-    if args.image is not None:
+    if args.snapshot is not None and args.image is not None:
+        print("Both an image and a snapshot given", file=sys.stderr)
+        sys.exit(1)
+
+    if args.snapshot is not None:
+        with args.snapshot.open("rb") as f:
+            prg = snapshot.read(f)
+    elif args.image is not None:
         with args.image.open("rb") as f:
             img = Image.read(f)
         prg = Program.from_image(img)
@@ -0,0 +1,61 @@
+'''
+Benchmark of the placement engine on synthetic routines of growing size.
+
+    python -m leaptools.bench [SIZE ...]
+'''
+import random
+import sys
+import time
+
+from .program import *
+from .dsl import Builder
+from . import passes
+
+DEFAULT_SIZES = [250, 500, 1000, 2000, 4000, 8000]
+
+def synthetic_program(ninstr, seed=0):
+    '''
+    Build a program with a single routine of about 'ninstr' instructions:
+    a mix of arithmetic on recent results, with the occasional port
+    access to exercise side effect ordering.
+    '''
+    rng = random.Random(seed)
+    prg = Program()
+    b = Builder(prg)
+    with b.Routine(waitfull_ports=[0x41]):
+        vals = [b.TAKE(0x41_000000)]
+        while len(prg.routines[0].instr) < ninstr:
+            a = vals[-1 - rng.randrange(min(len(vals), 16))]
+            c = vals[-1 - rng.randrange(min(len(vals), 16))]
+            kind = rng.randrange(8)
+            if kind == 0:
+                vals.append(b.TAKE(0x41_000000))
+            elif kind == 1:
+                b.PUT(a, 0x40_000000)
+            elif kind < 4:
+                vals.append(b.FMULTACC(a, c, 0.5))
+            elif kind < 6:
+                vals.append(b.FSUB(a, c))
+            else:
+                vals.append(b.ADD(a, c))
+    return prg
+
+def _timed(f, *args):
+    start = time.perf_counter()
+    ret = f(*args)
+    return ret, time.perf_counter() - start
+
+def bench(sizes):
+    print(f"{'instr':>6} {'constr':>7} {'lifo':>8} {'list':>8} {'check':>8}")
+    for size in sizes:
+        prg = synthetic_program(size)
+        rout = prg.routines[0]
+        constraints, _ = _timed(passes.get_placement_constraints, prg, rout)
+        _, t_lifo = _timed(passes._schedule_lifo, rout, constraints)
+        rout.instr, t_list = _timed(passes._schedule_list, rout, constraints)
+        _, t_check = _timed(passes.check_placement.__wrapped__, prg, 0)
+        print(f"{size:6d} {len(constraints):7d} "
+              f"{t_lifo:7.3f}s {t_list:7.3f}s {t_check:7.3f}s")
+
+if __name__ == "__main__":
+    bench([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
@@ -1,26 +1,14 @@
 import sys
-from .types import Opcode
+from .types import Opcode, OPCODE_INFO
 from .program import Routine, Instruction, Operand, Constant
 
 OPCODES = dict([(opcode.name, opcode) for opcode in Opcode])
 
-'''
-For some operations we need to adjust the operand mapping to make it
-more convenient (and save the user from having to pass in dummy operands
-to reach desired operand slots).
-'''
+# Operand slots the DSL fills in, see the 'sieve' field in OPCODE_INFO
+# (types.py)
 OPERAND_SIEVE = {
-	Opcode.TAKE:   (False, False, True),
-	Opcode.TAKEC:  (False, True, True),
-	Opcode.PEEK:   (False, False, True),
-	Opcode.PUT:    (True, False, True),
-	Opcode.PUTC:   (True, True, True),
-	Opcode.UPDATE: (True, False, True),
-	Opcode.F32_FMT: (False, True, True),
-	Opcode.FMULT:   (False, True, True),
-	Opcode.FMULT_NEG: (False, True, True),
-
-	Opcode.MULT0:  (False, True, True)
+	opcode: info.sieve for opcode, info in OPCODE_INFO.items()
+	if info.sieve is not None
 }
 
 class _EnterRoutineHelper:
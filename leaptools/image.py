@@ -1,5 +1,11 @@
 import sys
+import io
 import bisect
+import mmap
+import struct
+import zlib
+import hashlib
+from array import array
 from enum import IntFlag, IntEnum
 from construct import *
 
@@ -66,17 +72,217 @@ LEAPFROGImage = Struct(
     "section" / LEAPFROGSection[this.nsections], 
 )
 
+LEAPFROGPatchRun = Struct(
+    "offset" / Int32ul,
+    "size" / Int32ul,
+    "data" / Int32ul[this.size],
+)
+
+PATCH_NO_SOURCE = 0xffffffff
+
+LEAPFROGPatchSection = Struct(
+    # index of the section in the base image to start from (which
+    # then also gives the type, load base and size), or PATCH_NO_SOURCE
+    # to start from zeroes
+    "source" / Int32ul,
+    "type" / If(this.source == PATCH_NO_SOURCE, SectionTypeAdapter(Int32ul)),
+    "load_base" / If(this.source == PATCH_NO_SOURCE, Int32ul),
+    "size" / If(this.source == PATCH_NO_SOURCE, Int32ul),
+    "flags" / Default(Int32ul, 0),
+    "nruns" / Int32ul,
+    "run" / LEAPFROGPatchRun[this.nruns],
+)
+
+LEAPFROGPatch = Struct(
+    "magic" / Const(0x1ea9f1d1, Int32ul),
+    "fmtversion" / Const(0, Int32ul),
+    # CRC32 of the serialized base image
+    "base_crc" / Int32ul,
+    "imprint" / PaddedString(32, "ascii"),
+    "nsections" / Int32ul,
+    "section" / LEAPFROGPatchSection[this.nsections],
+)
+
+LEAPFROGBundleSection = Struct(
+    "type" / SectionTypeAdapter(Int32ul),
+    "load_base" / Int32ul,
+    "flags" / Default(Int32ul, 0),
+    # index of the blob holding the section data
+    "blob" / Int32ul,
+)
+
+LEAPFROGBundleVariant = Struct(
+    "name" / PaddedString(32, "ascii"),
+    "imprint" / PaddedString(32, "ascii"),
+    "nsections" / Int32ul,
+    "section" / LEAPFROGBundleSection[this.nsections],
+)
+
+LEAPFROGBundleBlob = Struct(
+    "size" / Int32ul,
+    "data" / Int32ul[this.size],
+)
+
+LEAPFROGBundle = Struct(
+    "magic" / Const(0x1ea9f1b0, Int32ul),
+    "fmtversion" / Const(0, Int32ul),
+    "nvariants" / Int32ul,
+    "variant" / LEAPFROGBundleVariant[this.nvariants],
+    "nblobs" / Int32ul,
+    "blob" / LEAPFROGBundleBlob[this.nblobs],
+)
+
 Section = LEAPFROGSectionType
 SectionFlags = LEAPFROGSectionFlags
 
+# Fixed-size parts of LEAPFROGImage/LEAPFROGSection, for the readers
+# and writers that bypass construct
+IMAGE_HEADER = struct.Struct("<II32sI")
+SECTION_HEADER = struct.Struct("<IIII")
+BUNDLE_HEADER = struct.Struct("<III")
+BUNDLE_VARIANT_HEADER = struct.Struct("<32s32sI")
+BUNDLE_SECTION = struct.Struct("<IIII")
+BUNDLE_BLOB_HEADER = struct.Struct("<I")
+
+def _map_buffer(f):
+    '''
+    Get a private, writable buffer with the content of a file,
+    memory-mapped if possible. The mapping is copy-on-write, modifications
+    don't reach the file. Bytes-like objects are copied, so that
+    modifications don't reach the caller's buffer either.
+    '''
+    if type(f) is str:
+        with open(f, "rb") as f:
+            return _map_buffer(f)
+    elif isinstance(f, (bytes, bytearray, memoryview)):
+        return memoryview(bytearray(f))
+
+    try:
+        if f.tell() == 0:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        pass
+    return memoryview(bytearray(f.read()))
+
+def _words_view(buf, off, size):
+    '''
+    Get a typed view of 'size' little-endian 32-bit words at offset 'off'
+    within buffer 'buf'. Zero-copy unless on a big-endian host.
+    '''
+    view = memoryview(buf)[off:off + 4 * size]
+    if sys.byteorder == "little":
+        return view.cast("I")
+    words = array("I", view)
+    words.byteswap()
+    return words
+
+def _walk_sections(buf):
+    '''
+    Parse the image header and section headers in 'buf'. Returns the
+    imprint and a list of (section header, data offset) pairs.
+    '''
+    magic, fmtversion, imprint, nsections = IMAGE_HEADER.unpack_from(buf, 0)
+    if magic != 0x1ea9f108 or fmtversion != 0:
+        raise ValueError(f"not a LEAPFROG image (magic {magic:#x} version {fmtversion})")
+
+    ret = []
+    off = IMAGE_HEADER.size
+    for _ in range(nsections):
+        type, load_base, size, flags = SECTION_HEADER.unpack_from(buf, off)
+        off += SECTION_HEADER.size
+        if off + 4 * size > len(buf):
+            raise ValueError(f"section {len(ret)} overruns the image")
+        ret.append((Container(
+            type=Section.try_cast(type),
+            load_base=load_base,
+            size=size,
+            flags=flags,
+        ), off))
+        off += 4 * size
+
+    return imprint.rstrip(b"\0").decode("ascii"), ret
+
+def _words_bytes(words):
+    '''
+    Get the little-endian serialization of a sequence of 32-bit words,
+    as a bytes-like object.
+    '''
+    if type(words) is memoryview and sys.byteorder == "little":
+        return words
+    words = array("I", words)
+    if sys.byteorder != "little":
+        words.byteswap()
+    return words
+
+def _diff_runs(old, new):
+    '''
+    Find the offsets at which word sequence 'new' differs from 'old' (of
+    the same length), as a list of [start, stop] runs. Runs separated by
+    no more words than a run header takes up get merged.
+    '''
+    runs = []
+    for i, (a, b) in enumerate(zip(old, new)):
+        if a == b:
+            continue
+        if len(runs) and i - runs[-1][1] <= 2:
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1])
+    return runs
+
+_PRINTABLE = bytes(i if 32 <= i < 128 else ord(".") for i in range(256))
+
+def hexdump(data, linesize=16):
+    '''
+    Format bytes the same way construct's hexdump() does (so that the
+    output can be read back with hexundump()), formatting whole lines
+    at a time.
+    '''
+    data = bytes(data)
+    if len(data) < 16**4:
+        addrdigits = 4
+    elif len(data) < 16**8:
+        addrdigits = 8
+    else:
+        raise ValueError("hexdump cannot process more than 16**8 or 4294967296 bytes")
+    hexwidth = 3 * linesize - 1
+    lines = ['hexundump("""']
+    for i in range(0, len(data), linesize):
+        line = data[i:i + linesize]
+        hextext = line.hex(" ").upper()
+        rawtext = line.translate(_PRINTABLE).decode("ascii")
+        lines.append(f"{i:0{addrdigits}X}   {hextext:<{hexwidth}}   {rawtext}")
+    lines.append('""")')
+    lines.append("")
+    return "\n".join(lines)
+
+def _index_key(entry):
+    return entry[:2]
+
+def _tolist(words):
+    return words if isinstance(words, list) else words.tolist()
+
 class Image:
     def __init__(self):
         self.sections = []
         self.bases = []
         self.imprint = ""
+        self.lazy = False
 
     @classmethod
-    def read(self, f):
+    def read(self, f, lazy=False):
+        '''
+        Read an image from a filename, a bytes-like object or a stream.
+
+        With 'lazy' set, only the section headers are parsed up front,
+        the data of a section is decoded the first time it is accessed
+        (see the 'materialized' property).
+        '''
+        if lazy:
+            ret = Image._from_buffer(_map_buffer(f))
+            ret.lazy = True
+            return ret
+
         if type(f) is str:
             with open(f, "rb") as f:
                 content = LEAPFROGImage.parse_stream(f)
@@ -92,69 +298,310 @@ class Image:
         ret.index()
         return ret
 
-    @property
-    def content(self):
+    @classmethod
+    def map(self, f):
+        '''
+        Read an image by memory-mapping it and walking the section headers
+        only. Data of each section is a typed view ('I' memoryview) straight
+        over the mapped file. Writes through __setitem__ are copy-on-write
+        and never reach the file. A bytes-like object is copied into
+        a private buffer instead of being mapped.
+        '''
+        return Image._from_buffer(_map_buffer(f))
+
+    @classmethod
+    def _from_buffer(self, buf):
+        imprint, headers = _walk_sections(buf)
+
+        ret = Image()
+        ret.imprint = imprint
+        for sect, off in headers:
+            sect.data = _words_view(buf, off, sect.size)
+            ret.sections.append(sect)
+        ret.index()
+        return ret
+
+    def _cropped_imprint(self):
         imprint_cropped = self.imprint
         if len(self.imprint) >= 32:
             imprint_cropped = self.imprint[:31]
             print(f"Warning: Cropping the imprint to {imprint_cropped!r}", file=sys.stderr)
+        return imprint_cropped
 
+    @property
+    def content(self):
         return Container(
-            imprint=imprint_cropped,
+            imprint=self._cropped_imprint(),
             nsections=len(self.sections),
             section=self.sections,
         )
 
+    def _chunks(self):
+        '''
+        Serialize the image into a sequence of bytes-like pieces, bypassing
+        construct. Section data go out as single buffers, mapped section
+        data without being copied at all.
+        '''
+        yield IMAGE_HEADER.pack(0x1ea9f108, 0,
+                                self._cropped_imprint().encode("ascii"),
+                                len(self.sections))
+        for sect in self.sections:
+            if len(sect.data) != sect.size:
+                raise ValueError(f"section of size {sect.size} holds {len(sect.data)} words")
+            yield SECTION_HEADER.pack(sect.type, sect.load_base, sect.size,
+                                      sect.get("flags", 0))
+            yield _words_bytes(sect.data)
+
     def write(self, f):
         if type(f) is str:
+            if any(isinstance(sect.data, memoryview) for sect in self.sections):
+                # serialize in full first, the sections might be mapped
+                # from the very file we are about to overwrite
+                data = bytes(self)
+                with open(f, "wb") as f:
+                    f.write(data)
+                return
             with open(f, "wb") as f:
-                LEAPFROGImage.build_stream(self.content, f)
-        else:
-            LEAPFROGImage.build_stream(self.content, f)
-
+                self.write(f)
+            return
+        for chunk in self._chunks():
+            f.write(chunk)
 
     def __bytes__(self):
-        return LEAPFROGImage.build(self.content)
+        return b"".join(self._chunks())
+
+    @classmethod
+    def section_digest(self, sect):
+        '''
+        Get the SHA-256 digest of a section covering its type, load base,
+        flags and data. The digest is cached with the section until it
+        is modified through __setitem__.
+        '''
+        if "_digest" not in sect:
+            h = hashlib.sha256(SECTION_HEADER.pack(sect.type, sect.load_base,
+                                                   sect.size, sect.get("flags", 0)))
+            h.update(_words_bytes(sect.data))
+            sect._digest = h.digest()
+        return sect._digest
+
+    @property
+    def digest(self):
+        '''
+        Digest of the image content, derived from the section digests
+        in order. The imprint is not covered.
+        '''
+        h = hashlib.sha256()
+        for sect in self.sections:
+            h.update(self.section_digest(sect))
+        return h.digest()
+
+    def changed_sections(self, prev):
+        '''
+        Compare the sections to those of an earlier image 'prev'. Returns
+        a list of (section, status) pairs, status being one of "same",
+        "changed" or "new" according to the content of a section of the
+        same type and load base in 'prev'.
+        '''
+        prev_digests = dict()
+        for sect in prev.sections:
+            prev_digests.setdefault((int(sect.type), sect.load_base), set()) \
+                    .add(prev.section_digest(sect))
+
+        ret = []
+        for sect in self.sections:
+            key = (int(sect.type), sect.load_base)
+            if key not in prev_digests:
+                status = "new"
+            elif self.section_digest(sect) in prev_digests[key]:
+                status = "same"
+            else:
+                status = "changed"
+            ret.append((sect, status))
+        return ret
+
+    def diff(self, new):
+        '''
+        Compute a patch turning this image into image 'new'. Sections of
+        'new' are matched to sections of the same type, load base and size
+        in this image, and the patch only carries the words that differ.
+        Returns a container to be built with LEAPFROGPatch.
+        '''
+        candidates = dict()
+        for i, sect in enumerate(self.sections):
+            key = (int(sect.type), sect.load_base, sect.size)
+            candidates.setdefault(key, []).append(i)
+
+        patch_sections = []
+        for sect in new.sections:
+            key = (int(sect.type), sect.load_base, sect.size)
+            data = _tolist(new._materialize(sect).data)
+            if candidates.get(key):
+                source = candidates[key].pop(0)
+                old_sect = self.sections[source]
+                if self.section_digest(old_sect) == new.section_digest(sect):
+                    runs = []
+                else:
+                    runs = _diff_runs(_tolist(self._materialize(old_sect).data), data)
+            else:
+                source = PATCH_NO_SOURCE
+                runs = _diff_runs([0] * sect.size, data)
+
+            patch_sections.append(Container(
+                type=sect.type,
+                load_base=sect.load_base,
+                size=sect.size,
+                flags=sect.get("flags", 0),
+                source=source,
+                nruns=len(runs),
+                run=[Container(offset=a, size=b - a, data=data[a:b])
+                     for a, b in runs],
+            ))
+
+        return Container(
+            base_crc=zlib.crc32(bytes(self)),
+            imprint=new._cropped_imprint(),
+            nsections=len(patch_sections),
+            section=patch_sections,
+        )
+
+    def patched(self, patch):
+        '''
+        Apply a patch (made by diff) to this image, returning the patched
+        image. Takes the patch as a container, a filename, bytes or a stream.
+        '''
+        if type(patch) is str:
+            with open(patch, "rb") as f:
+                patch = LEAPFROGPatch.parse_stream(f)
+        elif type(patch) in [bytes, bytearray]:
+            patch = LEAPFROGPatch.parse(patch)
+        elif not isinstance(patch, dict):
+            patch = LEAPFROGPatch.parse_stream(patch)
+
+        if zlib.crc32(bytes(self)) != patch.base_crc:
+            raise ValueError("patch doesn't apply to this image (base CRC mismatch)")
+
+        ret = Image()
+        ret.imprint = patch.imprint
+        for psect in patch.section:
+            if psect.source != PATCH_NO_SOURCE:
+                source = self._materialize(self.sections[psect.source])
+                sect = Container(
+                    type=source.type,
+                    load_base=source.load_base,
+                    size=source.size,
+                    flags=psect.flags,
+                    data=list(source.data),
+                )
+            else:
+                sect = Container(
+                    type=psect.type,
+                    load_base=psect.load_base,
+                    size=psect.size,
+                    flags=psect.flags,
+                    data=[0] * psect.size,
+                )
+            for run in psect.run:
+                sect.data[run.offset:run.offset + run.size] = run.data
+            ret.sections.append(sect)
+        ret.index()
+        return ret
 
     def index(self):
         self.bases = [
             (sect.type, sect.load_base, sect)
             for sect in self.sections
         ]
-        self.bases.sort()
+        self.bases.sort(key=_index_key)
 
     def reserve(self, type, span, flags=0):
-        self.sections.append(Container(
+        sect = self._new_section(type, span, flags)
+        self.sections.append(sect)
+        bisect.insort(self.bases, (sect.type, sect.load_base, sect),
+                      key=_index_key)
+
+    def reserve_many(self, specs):
+        '''
+        Reserve a number of sections at once, 'specs' being an iterable
+        of (type, span) or (type, span, flags) tuples. For a large batch
+        the index is re-sorted once instead of being updated per section.
+        '''
+        new = [self._new_section(*spec) for spec in specs]
+        self.sections += new
+        if len(new) > len(self.bases):
+            self.bases += [(sect.type, sect.load_base, sect) for sect in new]
+            self.bases.sort(key=_index_key)
+        else:
+            for sect in new:
+                bisect.insort(self.bases, (sect.type, sect.load_base, sect),
+                              key=_index_key)
+
+    @classmethod
+    def _new_section(self, type, span, flags=0):
+        return Container(
             type=Section.try_cast(type),
             load_base=span.start,
             size=len(span),
             flags=flags,
             data=[0] * len(span),
-        ))
-        self.index()
+        )
+
+    @property
+    def materialized(self):
+        '''
+        Indices of sections whose data have been decoded (of a lazily
+        read image, all other sections were only seen by their headers).
+        '''
+        return [i for i, sect in enumerate(self.sections)
+                if isinstance(sect.data, list)]
+
+    def _materialize(self, sect):
+        if self.lazy and not isinstance(sect.data, list):
+            sect.data = sect.data.tolist()
+        return sect
 
     def section_spans(self, types=None):
-        if types is not None:
+        if types is None:
             types = range(0, 1 << 32)
         return [(t, range(a, b)) for t, a, b in sorted(set([
             (sect.type, sect.load_base, sect.load_base + sect.size)
             for sect in self.sections  if (int(sect.type) in types)
         ]))]
 
-    def dump(self):
+    def dump(self, f=None, types=None, span=None):
+        '''
+        Print out the sections. The output can be restricted to sections
+        of the given 'types' and to the words at addresses within 'span'.
+        '''
+        if f is None:
+            f = sys.stdout
         for i, sect in enumerate(self.sections):
-            print(f"SECTION {i:d} TYPE {Section.format_str(sect.type)} LOAD BASE {sect.load_base:#x} FLAGS {sect.flags:x}")
+            if types is not None and sect.type not in types:
+                continue
+            start, stop = 0, sect.size
+            if span is not None:
+                start = max(span.start - sect.load_base, 0)
+                stop = min(span.stop - sect.load_base, sect.size)
+                if start >= stop:
+                    continue
+            self._materialize(sect)
 
             if sect.type in [Section.INST1, Section.INST2, Section.INST3]:
-                for off in range(0, sect.size, 16):
-                    line = "".join(f"{v:03x} " for v in sect.data[off:off+16])
-                    print(f"\t{line}")
+                rowsize, wordfmt = 16, "%03x "
             else:
-                for off in range(0, sect.size, 8):
-                    line = "".join(f"{v:08x} " for v in sect.data[off:off+8])
-                    print(f"\t{line}")
+                rowsize, wordfmt = 8, "%08x "
+            rowfmt = "\t" + wordfmt * rowsize + "\n"
+
+            out = [f"SECTION {i:d} TYPE {Section.format_str(sect.type)} LOAD BASE {sect.load_base:#x} FLAGS {sect.flags:x}\n"]
+            data = sect.data
+            for off in range(start, stop, rowsize):
+                row = tuple(data[off:min(off + rowsize, stop)])
+                if len(row) == rowsize:
+                    out.append(rowfmt % row)
+                else:
+                    out.append(("\t" + wordfmt * len(row) + "\n") % row)
+            f.write("".join(out))
 
-    def _lookup_section(self, secttype, addr):
+    def _lookup_section(self, secttype, addr, materialize=True):
         secttype = Section(secttype)
         idx = bisect.bisect_left(self.bases, (secttype, addr + 1)) - 1
         if idx < 0 or self.bases[idx][0] != secttype:
@@ -163,8 +610,68 @@ class Image:
         if addr >= sect.load_base + sect.size:
             return None
         assert addr >= sect.load_base
+        if materialize:
+            self._materialize(sect)
         return sect
 
+    def _lookup_span(self, secttype, start, stop):
+        '''
+        Find the sections backing the address range start..stop-1, which
+        may be spread over several contiguous sections. Returns a list
+        of (section, start offset, stop offset) pieces.
+        '''
+        pieces = []
+        addr = start
+        while addr < stop:
+            sect = self._lookup_section(secttype, addr)
+            if sect is None:
+                raise IndexError(f"no backing for {(secttype, addr)!r} in image")
+            end = min(stop, sect.load_base + sect.size)
+            pieces.append((sect, addr - sect.load_base, end - sect.load_base))
+            addr = end
+        return pieces
+
+    def _runs(self, secttype, addrs):
+        '''
+        Split a sequence of addresses into runs of consecutive addresses
+        within a single section. Yields (section, start offset, stop offset)
+        pieces in the order of the addresses.
+        '''
+        sect, base, end = None, 0, 0
+        start = stop = 0
+        for addr in addrs:
+            if sect is not None and addr == base + stop and addr < end:
+                stop += 1
+                continue
+            if sect is not None:
+                yield sect, start, stop
+            if not base <= addr < end:
+                sect = self._lookup_section(secttype, addr)
+                if sect is None:
+                    raise IndexError(f"no backing for {(secttype, addr)!r} in image")
+                base, end = sect.load_base, sect.load_base + sect.size
+            start, stop = addr - base, addr - base + 1
+        if sect is not None:
+            yield sect, start, stop
+
+    def _gather(self, secttype, addrs):
+        ret = []
+        for sect, start, stop in self._runs(secttype, addrs):
+            ret += sect.data[start:stop]
+        return ret
+
+    def _scatter(self, secttype, addrs, data):
+        if len(data) != len(addrs):
+            raise ValueError(f"{len(data)} words of data for {len(addrs)} addresses")
+        pos = 0
+        for sect, start, stop in self._runs(secttype, addrs):
+            chunk = data[pos:pos + stop - start]
+            if not isinstance(sect.data, list):
+                chunk = array("I", chunk)
+            sect.data[start:stop] = chunk
+            sect.pop("_digest", None)
+            pos += stop - start
+
     def __getitem__(self, spec):
         assert len(spec) == 2
 
@@ -174,27 +681,24 @@ class Image:
             return [self[secttype,spec[1]] for secttype \
                     in range(spec[0].start, spec[0].stop)]
         elif type(spec[1]) in [list, set]:
-            return [self[spec[0], addr] for addr in spec[1]]
+            return self._gather(spec[0], spec[1])
         elif type(spec[1]) in [range, slice]:
             if not (spec[1].stop is None or spec[1].stop > spec[1].start):
                 return []
-            sect = self._lookup_section(spec[0], spec[1].start)
             if spec[1].stop is None:
+                sect = self._lookup_section(spec[0], spec[1].start)
                 if sect is not None:
-                    return sect.data[spec[1].start - sect.load_base:]
+                    return _tolist(sect.data[spec[1].start - sect.load_base:])
                 else:
                     return []
-            if sect is None:
-                raise IndexError(f"no backing for {str(secttype)},{addr} in image")
-            elif spec[1].stop > sect.load_base + sect.size:
-                # canary for there being a followup section
-                self[spec[0],sect.load_base + sect.size]
-                # we passed the canary, there's data there but we
-                # leave this case unimplemented
-                raise NotImplementedError("slice overruns an image section")
-            else:
-                return sect.data[spec[1].start - sect.load_base \
-                                 :spec[1].stop - sect.load_base]
+            pieces = self._lookup_span(spec[0], spec[1].start, spec[1].stop)
+            if len(pieces) == 1:
+                sect, start, stop = pieces[0]
+                return _tolist(sect.data[start:stop])
+            ret = []
+            for sect, start, stop in pieces:
+                ret += sect.data[start:stop]
+            return ret
         else:
             sect = self._lookup_section(*spec)
             if sect is None:
@@ -212,30 +716,145 @@ class Image:
                     zip(range(spec[0].start, spec[0].stop), data):
                 self[secttype, spec[1]] = subdata
         elif type(spec[1]) in [list, set]:
-            for addr, subdata in zip(spec[1], data):
-                self[secttype, addr] = subdata
+            self._scatter(spec[0], spec[1], data)
         elif type(spec[1]) in [range, slice]:
             if spec[1].stop is None:
                 spec = (spec[0], slice(spec[1].start, spec[1].start + len(data)))
             if not spec[1].stop > spec[1].start:
                 return
-            sect = self._lookup_section(spec[0], spec[1].start)
-            if spec[1].stop > sect.load_base + sect.size:
-                # canary for there being a follow-up section
-                self[spec[0],sect.load_base + sect.size]
-                # we passed the canary, there's data there but we
-                # leave this case unimplemented
-                raise NotImplementedError("slice overruns an image section")
-            sect.data[spec[1].start - sect.load_base: \
-                      spec[1].stop - sect.load_base] = data
+            if len(data) != spec[1].stop - spec[1].start:
+                raise ValueError(f"{len(data)} words of data for a span of {spec[1].stop - spec[1].start}")
+            pos = 0
+            for sect, start, stop in self._lookup_span(spec[0], spec[1].start,
+                                                       spec[1].stop):
+                chunk = data[pos:pos + stop - start]
+                if not isinstance(sect.data, list):
+                    chunk = array("I", chunk)
+                sect.data[start:stop] = chunk
+                sect.pop("_digest", None)
+                pos += stop - start
         else:
             sect = self._lookup_section(*spec)
             if sect is None:
                 raise IndexError(f"no backing for {spec!r} in image")
             sect.data[spec[1] - sect.load_base] = data
+            sect.pop("_digest", None)
 
     def __contains__(self, key):
-        return self._lookup_section(*key) is not None
+        return self._lookup_section(*key, materialize=False) is not None
+
+class Bundle:
+    '''
+    A number of variant images stored together, with identical section
+    data kept only once (see LEAPFROGBundle).
+    '''
+    def __init__(self):
+        self.variants = dict()
+
+    def __getitem__(self, name):
+        return self.variants[name]
+
+    def __setitem__(self, name, img):
+        self.variants[name] = img
+
+    @classmethod
+    def read(self, f):
+        '''
+        Read a bundle, memory-mapping it. Variant images are lazy, their
+        section data are read-only views of the shared blobs until first
+        accessed through the image.
+        '''
+        buf = _map_buffer(f)
+        magic, fmtversion, nvariants = BUNDLE_HEADER.unpack_from(buf, 0)
+        if magic != 0x1ea9f1b0 or fmtversion != 0:
+            raise ValueError(f"not a LEAPFROG bundle (magic {magic:#x} version {fmtversion})")
+        off = BUNDLE_HEADER.size
+
+        variants = []
+        for _ in range(nvariants):
+            name, imprint, nsections = BUNDLE_VARIANT_HEADER.unpack_from(buf, off)
+            off += BUNDLE_VARIANT_HEADER.size
+            sections = []
+            for _ in range(nsections):
+                sections.append(BUNDLE_SECTION.unpack_from(buf, off))
+                off += BUNDLE_SECTION.size
+            variants.append((name, imprint, sections))
+
+        blobs = []
+        nblobs, = BUNDLE_BLOB_HEADER.unpack_from(buf, off)
+        off += BUNDLE_BLOB_HEADER.size
+        for _ in range(nblobs):
+            size, = BUNDLE_BLOB_HEADER.unpack_from(buf, off)
+            off += BUNDLE_BLOB_HEADER.size
+            if off + 4 * size > len(buf):
+                raise ValueError(f"blob {len(blobs)} overruns the bundle")
+            blobs.append((off, size))
+            off += 4 * size
+
+        ret = Bundle()
+        for name, imprint, sections in variants:
+            img = Image()
+            img.lazy = True
+            img.imprint = imprint.rstrip(b"\0").decode("ascii")
+            for type, load_base, flags, blob in sections:
+                blob_off, size = blobs[blob]
+                data = _words_view(buf, blob_off, size)
+                if isinstance(data, memoryview):
+                    data = data.toreadonly()
+                img.sections.append(Container(
+                    type=Section.try_cast(type),
+                    load_base=load_base,
+                    size=size,
+                    flags=flags,
+                    data=data,
+                ))
+            img.index()
+            ret.variants[name.rstrip(b"\0").decode("ascii")] = img
+        return ret
+
+    def _chunks(self):
+        blob_index = dict()
+        blobs = []
+        variant_headers = []
+
+        for name, img in self.variants.items():
+            if len(name.encode("ascii")) > 32:
+                raise ValueError(f"variant name too long: {name!r}")
+            entries = []
+            for sect in img.sections:
+                data = _words_bytes(sect.data)
+                key = hashlib.sha256(data).digest()
+                if key not in blob_index:
+                    blob_index[key] = len(blobs)
+                    blobs.append((sect.size, data))
+                entries.append(BUNDLE_SECTION.pack(sect.type, sect.load_base,
+                                                   sect.get("flags", 0),
+                                                   blob_index[key]))
+            variant_headers.append(BUNDLE_VARIANT_HEADER.pack(
+                name.encode("ascii"), img._cropped_imprint().encode("ascii"),
+                len(entries)
+            ) + b"".join(entries))
+
+        yield BUNDLE_HEADER.pack(0x1ea9f1b0, 0, len(variant_headers))
+        yield from variant_headers
+        yield BUNDLE_BLOB_HEADER.pack(len(blobs))
+        for size, data in blobs:
+            yield BUNDLE_BLOB_HEADER.pack(size)
+            yield data
+
+    def write(self, f):
+        if type(f) is str:
+            # serialize in full first, the bundle might be mapped from
+            # the very file we are about to overwrite
+            data = bytes(self)
+            with open(f, "wb") as f:
+                f.write(data)
+            return
+        for chunk in self._chunks():
+            f.write(chunk)
+
+    def __bytes__(self):
+        return b"".join(self._chunks())
 
 if __name__ == "__main__":
     import argparse
@@ -245,13 +864,45 @@ if __name__ == "__main__":
     parser.add_argument('filename')
     parser.add_argument('-s', '--save', type=str)
     parser.add_argument('-d', '--dump', action='store_true')
+    parser.add_argument('-t', '--dump-type', action='append',
+                        type=lambda s: LEAPFROGSectionType.try_cast(int(s, 16)),
+                        help='restrict the dump to a section type (repeatable)')
+    parser.add_argument('-r', '--dump-range',
+                        type=lambda s: range(*[int(v, 16) for v in s.split(":")]),
+                        help='restrict the dump to an address range START:STOP')
     parser.add_argument('-i', '--imprint', type=str)
     parser.add_argument('-a', '--add', type=lambda s: LEAPFROGSectionType(int(s, 16)))
     parser.add_argument('-l', '--load-base', type=int, default=0)
+    parser.add_argument('-p', '--patch', type=str,
+                        help='apply a patch file to the image')
+    parser.add_argument('--diff', type=str, nargs=2, metavar=('NEW', 'PATCH'),
+                        help='write a patch turning the image into NEW')
+    parser.add_argument('-x', '--extract', type=str, metavar='VARIANT',
+                        help='read the image as a variant from a bundle file')
+    parser.add_argument('-b', '--bundle-into', type=str, metavar='BUNDLE',
+                        help='store the image into a bundle file (see --variant)')
+    parser.add_argument('-n', '--variant', type=str,
+                        help='variant name to store the image under in the bundle')
 
     args = parser.parse_args()
 
-    img = Image.read(args.filename)
+    if args.extract:
+        img = Bundle.read(args.filename)[args.extract]
+    else:
+        img = Image.read(args.filename)
+
+    if args.diff:
+        new, patchname = args.diff
+        patch = img.diff(Image.read(new))
+        with open(patchname, "wb") as f:
+            LEAPFROGPatch.build_stream(patch, f)
+        nwords = sum(run.size for sect in patch.section for run in sect.run)
+        print(f"Patch carries {nwords} words in {sum(sect.nruns for sect in patch.section)} runs",
+              file=sys.stderr)
+        sys.exit(0)
+
+    if args.patch:
+        img = img.patched(args.patch)
 
     if args.add:
         data = sys.stdin.buffer.read()
@@ -263,8 +914,18 @@ if __name__ == "__main__":
     if args.imprint:
         img.imprint = args.imprint
 
-    if args.dump or not args.save:
-        img.dump()
+    if args.dump or not (args.save or args.bundle_into):
+        img.dump(types=args.dump_type, span=args.dump_range)
 
     if args.save:
         img.write(args.save)
+
+    if args.bundle_into:
+        if not args.variant:
+            parser.error("--bundle-into requires --variant")
+        try:
+            bundle = Bundle.read(args.bundle_into)
+        except FileNotFoundError:
+            bundle = Bundle()
+        bundle[args.variant] = img
+        bundle.write(args.bundle_into)
@@ -1,9 +1,16 @@
+import functools
+import heapq
 import itertools
+import math
+import os
+import struct
 import sys
-from construct import hexdump
+import time
 
 from .program import *
+from .image import hexdump
 from .dsl import Builder
+from . import snapshot
 
 PASSES = {}
 pass_counters = [1]
@@ -24,6 +31,7 @@ def program_pass(func):
         return ret
     wrapper.__name__ = func.__name__
     wrapper.__doc__ = func.__doc__
+    wrapper.__wrapped__ = func
     PASSES[name] = wrapper
 
     return wrapper
@@ -420,7 +428,246 @@ def wipe_inits(prg):
     '''
     Wipe any register initializations.
     '''
-    prg.register_inits = {}
+    prg.register_inits.clear()
+    prg.const_pool.clear()
+
+def _global_cases(prg):
+    '''
+    Collect all instructions updating a Global.
+    '''
+    cases = set()
+    for rout in prg.routines:
+        for inst in rout.instr:
+            if inst is None:
+                continue
+            for op in inst.ops:
+                if type(op) is Global:
+                    cases.update(op.cases)
+    return cases
+
+def _remove_instructions(rout, removed):
+    rout.instr = [inst for inst in rout.instr if inst not in removed]
+    if rout.selected is not None:
+        rout.selected = set(rout.selected) - removed
+
+def _replace_uses(prg, replacement):
+    '''
+    Rewrite operands throughout the program according to the
+    'replacement' mapping.
+    '''
+    for rout in prg.routines:
+        for inst in rout.instr:
+            if inst is None:
+                continue
+            inst.ops = [replacement.get(op, op) for op in inst.ops]
+
+@program_pass
+def cse(prg):
+    '''
+    Eliminate common subexpressions: merge instructions computing the same
+    opcode over the same operands, and rewrite users of the merged ones to
+    use the survivor.
+
+    Only considers instructions without side effects and without an output
+    set, which don't update a Global and whose operands are constants,
+    globals or results of other instructions.
+    '''
+    global_cases = _global_cases(prg)
+    replacement = dict()
+
+    def mergeable(inst):
+        return not inst.has_side_effects and inst.out is None \
+            and inst not in global_cases \
+            and all(type(op) in [Instruction, Constant, Global] or op is None
+                    for op in inst.ops)
+
+    for routidx, rout in enumerate(prg.routines):
+        seen = dict()
+        removed = set()
+        before = _min_slots(prg, rout)
+        for inst in rout.instr:
+            if inst is None:
+                continue
+            inst.ops = [replacement.get(op, op) for op in inst.ops]
+            if not mergeable(inst):
+                continue
+            key = (inst.opcode, tuple(inst.ops))
+            if key in seen:
+                replacement[inst] = seen[key]
+                removed.add(inst)
+            else:
+                seen[key] = inst
+
+        if len(removed):
+            _remove_instructions(rout, removed)
+            after = _min_slots(prg, rout)
+            print(f"Routine {routidx}: merged away {len(removed)} instructions, "
+                  f"saving {before - after} cycles (at least {before} down "
+                  f"to {after})", file=sys.stderr)
+
+    # Catch any users in other routines
+    _replace_uses(prg, replacement)
+
+def _signed32(val):
+    return val - (1 << 32) if val & 0x80000000 else val
+
+def _fold_int(ret):
+    # whether the hardware wraps or saturates, it agrees with
+    # plain arithmetic if there's no overflow
+    if not -(1 << 31) <= ret < (1 << 31):
+        return None
+    return ret & 0xffffffff
+
+def _f32_operand(val):
+    '''
+    Interpret a word as a float32, or return None if it isn't a normal
+    finite number or positive zero, for which we can't be sure of LEAP
+    semantics.
+    '''
+    exp = (val >> 23) & 0xff
+    if exp == 0xff or (exp == 0 and val & 0xffffffff):
+        return None
+    return struct.unpack("<f", struct.pack("<I", val))[0]
+
+def _f32_result(x):
+    '''
+    Round an exact (or double-precision) result of a single float32
+    operation to a float32 word, or return None if it falls outside
+    the normal range or is a negative zero.
+    '''
+    # Doubles carry more than twice the float32 mantissa, so rounding the
+    # double result of an operation on float32 values gives the correctly
+    # rounded float32 result
+    if x != 0 and not 2.0**-126 <= abs(x) < 2.0**128:
+        return None
+    if x == 0 and math.copysign(1, x) < 0:
+        return None
+    try:
+        return struct.unpack("<I", struct.pack("<f", x))[0]
+    except OverflowError:
+        # rounded up to infinity
+        return None
+
+def _fold_float(f):
+    def fold(*vals):
+        vals = [_f32_operand(val) for val in vals]
+        if None in vals:
+            return None
+        return f(*vals)
+    return fold
+
+def _fold_fadd_div2(a, b):
+    # the sum must be in range by itself, we don't know whether
+    # the hardware rounds in between
+    if _f32_result(a + b) is None:
+        return None
+    return _f32_result((a + b) / 2)
+
+# opcode -> (operand slots read, function computing the result word,
+# or returning None if folding isn't safe)
+_FOLDABLE = {
+    Opcode.AND: ((0, 1), lambda a, b: a & b),
+    Opcode.OR:  ((0, 1), lambda a, b: a | b),
+    Opcode.XOR: ((0, 1), lambda a, b: a ^ b),
+    Opcode.ADD: ((0, 1), lambda a, b: _fold_int(_signed32(a) + _signed32(b))),
+    Opcode.SUB: ((0, 1), lambda a, b: _fold_int(_signed32(b) - _signed32(a))),
+    Opcode.FMULT:     ((1, 2), _fold_float(lambda a, b: _f32_result(a * b))),
+    Opcode.FSUB:      ((0, 1), _fold_float(lambda a, b: _f32_result(b - a))),
+    Opcode.FADD_DIV2: ((0, 1), _fold_float(_fold_fadd_div2)),
+}
+
+def _fold(inst):
+    if inst.opcode not in _FOLDABLE:
+        return None
+    slots, f = _FOLDABLE[inst.opcode]
+    vals = []
+    for i, op in enumerate(inst.ops):
+        if i in slots:
+            if type(op) is not Constant or not 0 <= op.val <= 0xffffffff:
+                return None
+            vals.append(op.val)
+        elif op is not None:
+            return None
+    ret = f(*vals)
+    return Constant(ret) if ret is not None else None
+
+@program_pass
+def fold_constants(prg):
+    '''
+    Evaluate instructions with all-constant operands at compile time,
+    and replace uses of them with the resulting constants. Covers bitwise
+    operations, integer ADD/SUB as long as they don't overflow, and
+    FMULT/FSUB/FADD_DIV2 with float32 rounding (round-to-nearest-even)
+    as long as no non-finite or denormal values are involved.
+
+    Instructions updating a Global, or with an output set, are kept.
+    '''
+    global_cases = _global_cases(prg)
+    replacement = dict()
+
+    for routidx, rout in enumerate(prg.routines):
+        removed = set()
+        for inst in rout.instr:
+            if inst is None:
+                continue
+            inst.ops = [replacement.get(op, op) for op in inst.ops]
+            if inst.out is not None or inst in global_cases:
+                continue
+            const = _fold(inst)
+            if const is not None:
+                replacement[inst] = const
+                removed.add(inst)
+
+        if len(removed):
+            _remove_instructions(rout, removed)
+            print(f"Routine {routidx}: folded {len(removed)} instructions "
+                  "into constants", file=sys.stderr)
+
+    # Catch any users in other routines
+    _replace_uses(prg, replacement)
+
+@program_pass
+def dce(prg):
+    '''
+    Eliminate dead code: remove instructions whose results don't make it
+    into a side effect, an output register or a Global update, directly
+    or through other instructions.
+
+    NOPs put in by 'set_nops' are kept, and in routines which still have
+    empty slots the dead instructions leave empty slots behind, so that
+    the spacing of already placed routines is left intact.
+    '''
+    live = set()
+    stack = list(_global_cases(prg))
+    for rout in prg.routines:
+        for inst in rout.instr:
+            if inst is None:
+                continue
+            if inst.has_side_effects or inst.out is not None \
+                    or _is_nop(inst):
+                stack.append(inst)
+
+    while len(stack):
+        op = stack.pop()
+        if op in live or type(op) not in [Instruction, Global]:
+            continue
+        live.add(op)
+        stack.extend(op.deps())
+
+    for routidx, rout in enumerate(prg.routines):
+        removed = set(inst for inst in rout.instr
+                      if inst is not None and inst not in live)
+        if not len(removed):
+            continue
+        if None in rout.instr:
+            rout.instr = [None if inst in removed else inst
+                          for inst in rout.instr]
+            if rout.selected is not None:
+                rout.selected = set(rout.selected) - removed
+        else:
+            _remove_instructions(rout, removed)
+        print(f"Routine {routidx}: removed {len(removed)} dead instructions",
+              file=sys.stderr)
 
 def get_placement_constraints(prg, rout):
     instr = set([inst for inst in rout.instr if inst is not None])
@@ -432,10 +679,7 @@ def get_placement_constraints(prg, rout):
             continue
         for op in inst.ops:
             if op in instr:
-                spacing = 0
-                if op.opcode in [Opcode.FMULTSUB, Opcode.FMULTACC,
-                                 Opcode.FMULTACC_NEG]:
-                    spacing = 1
+                spacing = OPCODE_INFO[op.opcode].spacing
                 constraints.append((inst, op, spacing, 1, "result-to-operand"))
             if type(op) is Global:
                 for case in op.cases:
@@ -472,39 +716,43 @@ def check_placement(prg, routidx):
     rout = prg.routines[routidx]
     constraints = get_placement_constraints(prg, rout)
 
+    # first occurence of each instruction, like list.index() would find
+    position = dict()
+    for idx, inst in enumerate(rout.instr):
+        position.setdefault(inst, idx)
+
     for constr in constraints:
         endp, base, offset, cost, cause = constr
-        base_idx = rout.instr.index(base)
-        endp_idx = rout.instr.index(endp)
+        base_idx = position[base]
+        endp_idx = position[endp]
 
         if endp_idx <= base_idx + offset:
             print("Constraint violation:", file=sys.stderr)
             _print_constraint(constr, base_idx=base_idx, endp_idx=endp_idx)
 
-@program_pass
-def place_routine(prg, routidx):
+def _schedule_lifo(rout, constraints):
     '''
-    Order instructions to satisfy constraints (single routine).
+    Place instructions by picking whichever became ready last.
     '''
-    rout = prg.routines[routidx]
-
     instr = set(rout.instr)
-    constraints = get_placement_constraints(prg, rout)
 
-    inst_blockers = dict()
+    # per instruction, the number of constraints it's blocked on, and
+    # the indices of constraints it's the base of
+    nblockers = dict()
     blocking = dict()
     for inst in rout.instr:
-        inst_blockers[inst] = []
+        nblockers[inst] = 0
         blocking[inst] = []
 
-    for const in constraints:
+    for constr_idx, const in enumerate(constraints):
         endp, base, offset, cost, _ = const
-        inst_blockers[endp].append(const)
-        blocking[base].append(const)
+        nblockers[endp] += 1
+        blocking[base].append(constr_idx)
+    met = bytearray(len(constraints))
 
     ready = []
     for inst in rout.instr:
-        if not len(inst_blockers[inst]):
+        if not nblockers[inst]:
             ready.append(inst)
 
     placed = []
@@ -520,34 +768,342 @@ def place_routine(prg, routidx):
             ioi = placed[-1 - back]
             if ioi is None:
                 continue
-            for const in blocking[ioi]:
-                endp, base, offset, cost, _ = const
-                if offset > back or not len(inst_blockers[endp]):
+            for constr_idx in blocking[ioi]:
+                endp, base, offset, cost, _ = constraints[constr_idx]
+                if offset > back or met[constr_idx]:
                     continue
-                if const in inst_blockers[endp]:
-                    inst_blockers[endp].remove(const)
-                if not len(inst_blockers[endp]):
+                met[constr_idx] = 1
+                nblockers[endp] -= 1
+                if not nblockers[endp]:
                     ready.append(endp)
 
         if set(placed[-2:]) == set([None]):
-            print("Blockers:", sys.stderr)
-            for constr in [c for l in inst_blockers.values() for c in l]:
-                _print_constraint(constr)
+            print("Blockers:", file=sys.stderr)
+            for constr_idx, constr in enumerate(constraints):
+                if not met[constr_idx]:
+                    _print_constraint(constr)
             
             raise RuntimeError("stuck")
 
-    # TODO: optimize the initial placement further
+    return placed
+
+def _constraint_graph(instr, constraints):
+    '''
+    Turn placement constraints into a successor graph, with edges carrying
+    the minimal distance between the two instructions' slots.
+    '''
+    succs = {inst: [] for inst in instr}
+    npreds = {inst: 0 for inst in instr}
+    for endp, base, offset, cost, _ in constraints:
+        # endp_idx > base_idx + offset, and no two instructions share a slot
+        succs[base].append((endp, max(offset + 1, 1)))
+        npreds[endp] += 1
+    return succs, npreds
+
+def _topological_order(instr, succs, npreds):
+    '''
+    Order instructions so that every constraint goes forward. Instructions
+    on constraint loops are left out.
+    '''
+    left = dict(npreds)
+    order = [inst for inst in instr if not left[inst]]
+    for inst in order:
+        for succ, _ in succs[inst]:
+            left[succ] -= 1
+            if not left[succ]:
+                order.append(succ)
+    return order
+
+def _critical_heights(instr, succs, npreds):
+    '''
+    For each instruction compute the length of the longest chain of
+    constraints it starts (its distance from the end of the routine
+    in the best case).
+    '''
+    # instructions on constraint loops keep a zero height, scheduling
+    # will report them as stuck
+    heights = {inst: 0 for inst in instr}
+    for inst in reversed(_topological_order(instr, succs, npreds)):
+        for succ, dist in succs[inst]:
+            heights[inst] = max(heights[inst], heights[succ] + dist)
+    return heights
+
+def _min_slots(prg, rout):
+    '''
+    Lower bound on the number of slots (and so cycles) the routine can be
+    placed in: at least one per instruction, and no fewer than the longest
+    chain of constraints spans.
+    '''
+    instr = [inst for inst in rout.instr if inst is not None]
+    succs, npreds = _constraint_graph(instr,
+                                      get_placement_constraints(prg, rout))
+    heights = _critical_heights(instr, succs, npreds)
+    return max([len(instr)] + [heights[inst] + 1 for inst in instr])
+
+def _earliest_slots(instr, succs, npreds):
+    '''
+    For each instruction compute the earliest slot the constraints
+    leading up to it allow.
+    '''
+    earliest = {inst: 0 for inst in instr}
+    for inst in _topological_order(instr, succs, npreds):
+        for succ, dist in succs[inst]:
+            earliest[succ] = max(earliest[succ], earliest[inst] + dist)
+    return earliest
+
+def _schedule_list(rout, constraints):
+    '''
+    Place instructions by list scheduling: fill each slot with the ready
+    instruction heading the longest critical path (ties broken by number of
+    successors, then by original order), and only put in a NOP if no
+    instruction can go in the slot.
+    '''
+    instr = [inst for inst in rout.instr if inst is not None]
+    succs, npreds = _constraint_graph(instr, constraints)
+    heights = _critical_heights(instr, succs, npreds)
+
+    # heap keys, unique thanks to the original index
+    priority = {
+        inst: (-heights[inst], -len(succs[inst]), i)
+        for i, inst in enumerate(instr)
+    }
+
+    left = dict(npreds)
+    earliest = {inst: 0 for inst in instr}
+    # instructions with all constraints' bases placed, keyed by priority
+    # if they can go in the current slot, else by the earliest slot they
+    # can go in
+    ready = [(priority[inst], inst) for inst in instr if not left[inst]]
+    heapq.heapify(ready)
+    waiting = []
+
+    placed = []
+    nplaced = 0
+    while nplaced < len(instr):
+        slot = len(placed)
+        while len(waiting) and waiting[0][0] <= slot:
+            _, prio, inst = heapq.heappop(waiting)
+            heapq.heappush(ready, (prio, inst))
+
+        if not len(ready):
+            if not len(waiting):
+                print("Blockers:", file=sys.stderr)
+                for constr in constraints:
+                    if left[constr[0]]:
+                        _print_constraint(constr)
+                raise RuntimeError("stuck")
+            placed.extend([None] * (waiting[0][0] - slot))
+            continue
+
+        _, inst = heapq.heappop(ready)
+        placed.append(inst)
+        nplaced += 1
+        for succ, dist in succs[inst]:
+            earliest[succ] = max(earliest[succ], slot + dist)
+            left[succ] -= 1
+            if not left[succ]:
+                heapq.heappush(waiting, (earliest[succ], priority[succ], succ))
+
+    return placed
+
+def _schedule_sat_fixed(instr, succs, heights, earliest, length, prop_limit):
+    '''
+    Try to place instructions into exactly 'length' slots. Returns the
+    placement, None if there's provably none, or False if the solver gave
+    up on reaching the propagation limit.
+    '''
+    # SAT variable: is instruction X placed in slot T?
+    var = dict()
+    window = dict()
+    for inst in instr:
+        window[inst] = range(earliest[inst], length - heights[inst])
+        if not len(window[inst]):
+            return None
+        for t in window[inst]:
+            var[inst, t] = len(var) + 1
+
+    clauses = []
+    occupants = [[] for _ in range(length)]
+    for inst in instr:
+        vs = [var[inst, t] for t in window[inst]]
+        # each instruction is placed exactly once
+        clauses.append(vs)
+        clauses.extend([-a, -b] for a, b in itertools.combinations(vs, 2))
+        for t in window[inst]:
+            occupants[t].append(var[inst, t])
+
+    # at most one instruction in a slot
+    for vs in occupants:
+        clauses.extend([-a, -b] for a, b in itertools.combinations(vs, 2))
+
+    # if the base of a constraint is in slot T, its endpoint is
+    # at least the constraint's distance after T
+    for inst in instr:
+        for succ, dist in succs[inst]:
+            for t in window[inst]:
+                clauses.append([-var[inst, t]] + [
+                    var[succ, u] for u in window[succ] if u >= t + dist
+                ])
+
+    import pycosat
+    sol = pycosat.solve(clauses, prop_limit=prop_limit)
+    if sol == "UNSAT":
+        return None
+    elif type(sol) is not list:
+        return False
+
+    placed = [None] * length
+    for (inst, t), v in var.items():
+        if sol[v - 1] > 0:
+            placed[t] = inst
+    return placed
+
+def _schedule_sat(rout, constraints, bound, budget, prop_limit=1000000):
+    '''
+    Search for a placement of minimal length by solving for fixed lengths
+    going up from a lower bound, and stopping short of 'bound'. Returns
+    None if there's no placement shorter than 'bound' or the search ran
+    over the time budget (in seconds) without finding one.
+    '''
+    instr = [inst for inst in rout.instr if inst is not None]
+    succs, npreds = _constraint_graph(instr, constraints)
+    heights = _critical_heights(instr, succs, npreds)
+    earliest = _earliest_slots(instr, succs, npreds)
+
+    start = time.monotonic()
+    length = max([len(instr)] + [earliest[inst] + heights[inst] + 1
+                                 for inst in instr])
+    while length < bound:
+        if time.monotonic() - start > budget:
+            print(f"Optimal placement search ran out of time at length {length}",
+                  file=sys.stderr)
+            return None
+        placed = _schedule_sat_fixed(instr, succs, heights, earliest,
+                                     length, prop_limit)
+        if placed is False:
+            print(f"Optimal placement search gave up at length {length}",
+                  file=sys.stderr)
+            return None
+        elif placed is not None:
+            return placed
+        length += 1
+
+    return None
+
+# Routines up to this many instructions are eligible for optimal placement
+SAT_PLACEMENT_MAX_INSTR = 64
+
+@program_pass
+def place_routine(prg, routidx, mode="list", budget=10.0):
+    '''
+    Order instructions to satisfy constraints (single routine).
+
+    With mode 'optimal', routines of up to SAT_PLACEMENT_MAX_INSTR
+    instructions are placed in the minimal number of slots by means of
+    a SAT solver, falling back to list scheduling if the search exceeds
+    the time budget (in seconds).
+    '''
+    assert mode in ["list", "optimal"]
+    rout = prg.routines[routidx]
+    constraints = get_placement_constraints(prg, rout)
+
+    placed = _schedule_list(rout, constraints)
+    # The LIFO placement is only there as a baseline to compare against,
+    # it can't cope with latencies above 2
+    try:
+        lifo = _schedule_lifo(rout, constraints)
+    except RuntimeError:
+        lifo = None
+    if lifo is not None and len(lifo) < len(placed):
+        placed = lifo
+
+    ninstr = len(placed) - placed.count(None)
+    if mode == "optimal" and ninstr <= SAT_PLACEMENT_MAX_INSTR:
+        optimal = _schedule_sat(rout, constraints, len(placed), budget)
+        if optimal is not None:
+            placed = optimal
+
+    naive = f"{lifo.count(None)} NOPs" if lifo is not None else "stuck"
+    print(f"Placed {len(placed) - placed.count(None)} instructions in "
+          f"{len(placed)} slots, {placed.count(None)} NOPs "
+          f"(naive placement: {naive})", file=sys.stderr)
+
     rout.instr = placed
 
     check_placement(prg, routidx)
 
 @program_pass
-def place(prg):
+def place(prg, mode="list", budget=10.0):
     '''
     Order instructions to satisfy constraints (all of program).
     '''
     for i, _ in enumerate(prg.routines):
-        place_routine(prg, i)
+        place_routine(prg, i, mode, budget)
+
+def _color_banks(nnodes, edges):
+    '''
+    Try to 3-color a conflict graph with the DSatur heuristic: color
+    the node with the most distinctly-colored neighbors next (ties broken
+    by degree, then by index), with the lowest color free. Returns None
+    if some node ends up with no color free.
+    '''
+    adj = [[] for _ in range(nnodes)]
+    for a, b in edges:
+        adj[a].append(b)
+        adj[b].append(a)
+
+    colors = [None] * nnodes
+    neighbor_colors = [set() for _ in range(nnodes)]
+    queue = [(0, -len(adj[node]), node) for node in range(nnodes)]
+    heapq.heapify(queue)
+
+    while len(queue):
+        negsat, _, node = heapq.heappop(queue)
+        if colors[node] is not None or -negsat != len(neighbor_colors[node]):
+            # stale entry
+            continue
+        free = [c for c in range(3) if c not in neighbor_colors[node]]
+        if not len(free):
+            return None
+        colors[node] = free[0]
+        for other in adj[node]:
+            if colors[other] is None and free[0] not in neighbor_colors[other]:
+                neighbor_colors[other].add(free[0])
+                heapq.heappush(queue, (-len(neighbor_colors[other]),
+                                       -len(adj[other]), other))
+
+    return colors
+
+def _solve_banks(nnodes, edges):
+    # SAT variable: is output of node X stored in bank Y?
+    bank_var = [(3*i + 1, 3*i + 2, 3*i + 3) for i in range(nnodes)]
+
+    clauses = []
+
+    for bv in bank_var:
+        clauses.append(list(bv))
+
+    for a, b in edges:
+        for bank in range(3):
+            clauses.append([-bank_var[a][bank], -bank_var[b][bank]])
+
+    import pycosat
+    sol = pycosat.solve(clauses)
+    if type(sol) is not list:
+        raise RuntimeError(f"SAT solver couldn't solve for bank assignment: code {sol}")
+
+    return [[sol[i - 1] > 0 for i in bv].index(True) for bv in bank_var]
+
+# Routines tend to repeat, so remember the assignments of some recently
+# seen conflict graphs (keyed by node count and sorted edge tuple)
+@functools.lru_cache(maxsize=64)
+def _assign_banks(nnodes, edges):
+    '''
+    Assign one of three banks to each node of a conflict graph so that
+    no two nodes joined by an edge share a bank. Returns a tuple of bank
+    indices (0 to 2).
+    '''
+    return tuple(_color_banks(nnodes, edges) or _solve_banks(nnodes, edges))
 
 @program_pass
 def regalloc_intermediate(prg, routidx=None):
@@ -564,7 +1120,9 @@ def regalloc_intermediate(prg, routidx=None):
         return
 
     rout = prg.routines[routidx]
-    instr_of_interest = set()
+    # in order of first use, so that the bank assignment problem
+    # comes out the same run to run
+    instr_of_interest = dict()
     edges = set()
 
     for inst in rout.instr:
@@ -575,62 +1133,112 @@ def regalloc_intermediate(prg, routidx=None):
             op for op in inst.ops if type(op) in [Instruction, Global]
         ]
 
-        for inst in inst_deps:
-            instr_of_interest.add(inst)
+        for dep in inst_deps:
+            instr_of_interest.setdefault(dep, len(instr_of_interest))
 
-        for comb in itertools.combinations(inst_deps, 2):
-            if comb[0] == comb[1]:
+        for a, b in itertools.combinations(inst_deps, 2):
+            if a is b:
                 continue
-            edges.add(frozenset(comb))
-
-    # SAT variable: is output of instruction X stored in bank Y?
-    bank_var = {
-        inst: (i+1, i+2, i+3)
-        for inst, i in zip(instr_of_interest,
-                           range(0, 3 * len(instr_of_interest), 3))
-    }
-
-    clauses = []
+            a, b = sorted([instr_of_interest[a], instr_of_interest[b]])
+            edges.add((a, b))
 
-    for _, bv in bank_var.items():
-        clauses.append(list(bv))
-
-    for edge in edges:
-        a, b = edge
-        for bank in range(3):
-            clauses.append([-bank_var[a][bank], -bank_var[b][bank]])
-
-    import pycosat
-    sol = pycosat.solve(clauses)
-    if type(sol) is not list:
-        raise RuntimeError(f"SAT solver couldn't solve for bank assignment: code {sol}")
+    banks = _assign_banks(len(instr_of_interest), tuple(sorted(edges)))
 
     allocators = [
         RegAllocator(bank, prg.register_allocated)
         for bank in [1, 2, 3]
     ]
 
-    for inst in instr_of_interest:
-        indices = bank_var[inst]
-        bank = [sol[i - 1] > 0 for i in indices].index(True)
-        reg = allocators[bank]()
+    def assigned_bank(inst):
+        return banks[instr_of_interest[inst]]
+
+    # Intermediate results are live from the slot of the instruction
+    # producing them up to the slot of their last use. Once the last use
+    # has passed, their register can be reused for a result produced later
+    # on. Globals, anything not produced within the routine, and anything
+    # other routines read keep their registers for good.
+    position = {inst: idx for idx, inst in enumerate(rout.instr)
+                if inst is not None}
+    used_elsewhere = set()
+    for other in prg.routines:
+        if other is rout:
+            continue
+        for inst in other.instr:
+            if inst is None:
+                continue
+            for op in inst.ops:
+                used_elsewhere.add(op)
+                if type(op) is Global:
+                    used_elsewhere.update(op.cases)
+    last_use = dict()
+    for idx, inst in enumerate(rout.instr):
+        if inst is None:
+            continue
+        for op in inst.ops:
+            if op in instr_of_interest:
+                last_use[op] = idx
+
+    def is_intermediate(inst):
+        return type(inst) is Instruction and inst in position \
+            and inst not in used_elsewhere
+
+    intermediates = sorted([
+        inst for inst in instr_of_interest if is_intermediate(inst)
+    ], key=lambda inst: position[inst])
+    permanent = [
+        inst for inst in instr_of_interest if not is_intermediate(inst)
+    ]
+
+    nassigned = [0, 0, 0]
+    for inst in permanent + intermediates:
+        nassigned[assigned_bank(inst)] += 1
+
+    for inst in permanent:
+        reg = allocators[assigned_bank(inst)]()
         prg.register_allocated.add(reg)
         inst.out = reg
+
+    live = []
+    for inst in intermediates:
+        while len(live) and live[0][0] < position[inst]:
+            _, _, reg = heapq.heappop(live)
+            allocators[reg.bank - 1].free(reg)
+        reg = allocators[assigned_bank(inst)]()
+        prg.register_allocated.add(reg)
+        inst.out = reg
+        heapq.heappush(live, (last_use[inst], position[inst], reg))
+
+    # Instructions updating a global write into its register
+    for inst in permanent:
         if type(inst) is Global:
             for case in inst.cases:
                 if type(case) is Instruction:
-                    case.out = reg
+                    case.out = inst.out
                 elif type(case) is Constant:
-                    prg.register_inits[reg] = case.val
+                    prg.register_inits[inst.out] = case.val
+
+    pressure = ", ".join(
+        f"bank {alloc.bank} peak {alloc.peak} ({n} without reuse)"
+        for alloc, n in zip(allocators, nassigned)
+    )
+    print(f"Register pressure: {pressure}", file=sys.stderr)
 
 @program_pass
 def regalloc_const(prg, routidx=None):
     '''
     Allocate registers for constants.
+
+    Constant registers are pooled program-wide: all uses of a value
+    in a given bank share a register (kept track of in 'prg.const_pool').
+    Where an instruction leaves a choice of banks for its constants,
+    banks already holding the values are preferred.
     '''
     if routidx is None:
         for i, _ in enumerate(prg.routines):
             regalloc_const(prg, i)
+        print(f"Constant pool: {len(prg.const_pool)} registers holding "
+              f"{len(set(val for _, val in prg.const_pool))} distinct values",
+              file=sys.stderr)
         return
 
     rout = prg.routines[routidx]
@@ -651,14 +1259,39 @@ def regalloc_const(prg, routidx=None):
             if op.bank in free_banks:
                 free_banks.remove(op.bank)
 
-        for i, op in enumerate(inst.ops):
-            if type(op) is not Constant:
-                continue
-            bank = free_banks.pop()
-            reg = allocators[bank - 1]()
-            prg.register_inits[reg] = op.val
-            inst.ops[i] = reg
-            prg.register_allocated.add(reg)
+        # the same value twice in an instruction can be read from
+        # a single register
+        consts = []
+        for op in inst.ops:
+            if type(op) is Constant and op not in consts:
+                consts.append(op)
+        if not len(consts):
+            continue
+
+        # Pick the assignment of banks to constants with the most values
+        # found pooled already, on a tie the first one in the order banks
+        # were handed out in before pooling
+        choices = itertools.permutations(reversed(free_banks), len(consts))
+        banks = max(choices, key=lambda banks: sum(
+            (bank, const.val) in prg.const_pool
+            for bank, const in zip(banks, consts)
+        ))
+
+        for bank, const in zip(banks, consts):
+            reg = prg.const_pool.get((bank, const.val))
+            if reg is None:
+                reg = allocators[bank - 1]()
+                prg.register_inits[reg] = const.val
+                prg.register_allocated.add(reg)
+                prg.const_pool[bank, const.val] = reg
+            for i, op in enumerate(inst.ops):
+                if op is const:
+                    inst.ops[i] = reg
+
+def _is_nop(inst):
+    # the filler 'set_nops' puts in empty slots
+    return inst.opcode == Opcode.AND and inst.out is None \
+        and all(op is None for op in inst.ops)
 
 @program_pass
 def set_nops(prg):
@@ -708,6 +1341,25 @@ def load_dsl(prg, fname):
     print(f"Built {b.nroutines} routines containing {b.ninstr} instructions.",
           file=sys.stderr)
 
+@program_pass
+def snapshot_save(prg, fname):
+    '''
+    Save a snapshot of the program at this point to a file, for
+    a later run to pick up from (see 'snapshot_load' or the --snapshot
+    command-line option).
+    '''
+    with open(fname, "wb") as f:
+        snapshot.write(prg, f)
+
+@program_pass
+def snapshot_load(prg, fname):
+    '''
+    Replace the program with one restored from a snapshot file.
+    '''
+    with open(fname, "rb") as f:
+        loaded = snapshot.read(f)
+    prg.__dict__.update(loaded.__dict__)
+
 @program_pass
 def arrange_routines(prg):
     '''
@@ -718,28 +1370,48 @@ def arrange_routines(prg):
         r.base = base
         base += len(r.instr) + 1
 
+def _describe_image(img, prev=None):
+    print(f"Writing image with {len(img.sections)} sections:", file=sys.stderr)
+    status = dict()
+    if prev is not None:
+        status = {id(sect): st for sect, st in img.changed_sections(prev)}
+    for sect in img.sections:
+        note = f" ({status[id(sect)]})" if id(sect) in status else ""
+        print(f"    {sect.type.name:6s} base {sect.load_base:x} size {sect.size:x} flags {sect.flags}{note}",
+              file=sys.stderr)
+    print(f"Image digest {img.digest.hex()}", file=sys.stderr)
+
 @program_pass
 def image(prg):
     '''
     Build a program image, output it on standard output.
     '''
     img = prg.build_image()
-    print(f"Writing image with {len(img.sections)} sections:", file=sys.stderr)
-    for sect in img.sections:
-        print(f"    {sect.type.name:6s} base {sect.load_base:x} size {sect.size:x} flags {sect.flags}",
-              file=sys.stderr)
+    _describe_image(img)
     img.write(sys.stdout.buffer)
 
 @program_pass
 def image_write(prg, fname):
     '''
-    Build a program image, output it on standard output.
+    Build a program image, write it into a file. Sections are compared
+    to a previous image in the file, if any, and the file is left
+    untouched if the content is the same.
     '''
     img = prg.build_image()
-    print(f"Writing image with {len(img.sections)} sections:", file=sys.stderr)
-    for sect in img.sections:
-        print(f"    {sect.type.name:6s} base {sect.load_base:x} size {sect.size:x} flags {sect.flags}",
-              file=sys.stderr)
+    prev = None
+    if os.path.exists(fname):
+        try:
+            # read in full rather than mapped, as we may be about
+            # to overwrite the file
+            with open(fname, "rb") as f:
+                prev = Image.read(f.read(), lazy=True)
+        except (ValueError, struct.error) as e:
+            print(f"Ignoring previous image in {fname}: {e}", file=sys.stderr)
+    _describe_image(img, prev)
+    if prev is not None and prev.digest == img.digest \
+            and prev.imprint == img.imprint:
+        print(f"Image in {fname} is up to date.", file=sys.stderr)
+        return
     with open(fname, "wb") as f:
         img.write(f)
 
@@ -749,10 +1421,7 @@ def image_inline(prg):
     Build a program image, return it (to be embedded in other passes).
     '''
     img = prg.build_image()
-    print(f"Writing image with {len(img.sections)} sections:", file=sys.stderr)
-    for sect in img.sections:
-        print(f"    {sect.type.name:6s} base {sect.load_base:x} size {sect.size:x} flags {sect.flags}",
-              file=sys.stderr)
+    _describe_image(img)
     return bytes(img)
 
 @program_pass
@@ -761,10 +1430,7 @@ def image_hexdump(prg):
     Build a program image, print its hexdump.
     '''
     img = prg.build_image()
-    print(f"Writing image with {len(img.sections)} sections:", file=sys.stderr)
-    for sect in img.sections:
-        print(f"    {sect.type.name:6s} base {sect.load_base:x} size {sect.size:x} flags {sect.flags}",
-              file=sys.stderr)
+    _describe_image(img)
     print(hexdump(bytes(img), linesize=16))
 
 @program_pass
@@ -775,6 +1441,8 @@ def compile_dsl(prg=None, fname=""):
     if prg is None:
         prg = Program()
     load_dsl(prg, fname)
+    fold_constants(prg)
+    dce(prg)
     place(prg)
     regalloc_intermediate(prg)
     propagate_outs(prg)
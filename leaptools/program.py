@@ -1,11 +1,15 @@
+import heapq
 import struct
 import sys
+import weakref
+from array import array
+from collections.abc import MutableMapping
 
 from .types import *
 from .image import Image, Section, SectionFlags
 
 class Operand:
-    pass
+    __slots__ = ()
 
 class BadOperand(Operand):
     def __init__(self):
@@ -21,14 +25,35 @@ class BadOperand(Operand):
         return type(other) is type(self)
 
 class Uninitialized(Operand):
+    __slots__ = ()
+
     def __init__(self):
         pass
 
 class Constant(Operand):
-    def __init__(self, val):
+    '''
+    Constants are interned: constructing a Constant of a value for which
+    one exists already gives out the existing object.
+    '''
+    __slots__ = ("val", "__weakref__")
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, val):
         if isinstance(val, float):
-            val = self.from_float(val).val
-        self.val = val
+            val = int.from_bytes(struct.pack('>f', val), byteorder="big")
+        const = cls._interned.get(val)
+        if const is None:
+            const = object.__new__(cls)
+            const.val = val
+            cls._interned[val] = const
+        return const
+
+    def __init__(self, val):
+        # set up by __new__
+        pass
+
+    def __reduce__(self):
+        return (Constant, (self.val,))
 
     @classmethod
     def from_float(self, val):
@@ -97,6 +122,8 @@ class RegisterRing:
         return f"<ring {id(self):#x} bank {self.bank!r} depth {self.depth!r} width {self.width!r}>"
 
 class RingOperand(Operand):
+    __slots__ = ("ring", "offset")
+
     def __init__(self, ring, offset):
         assert type(ring) is RegisterRing
         self.ring = ring
@@ -109,6 +136,22 @@ class RingOperand(Operand):
         return f"offset {self.offset} in {self.ring!r}"
 
 class Register(Operand):
+    '''
+    Registers are interned: there's at most one Register object for
+    any bank and address.
+    '''
+    __slots__ = ("bank", "addr", "_hash")
+    _interned = dict()
+
+    def __new__(cls, bank, addr):
+        reg = cls._interned.get((bank, addr))
+        if reg is None:
+            reg = object.__new__(cls)
+            reg.bank, reg.addr = bank, addr
+            reg._hash = hash((bank, addr))
+            cls._interned[(bank, addr)] = reg
+        return reg
+
     @classmethod
     def parse(self, name):
         name = name.strip()
@@ -122,16 +165,23 @@ class Register(Operand):
         )
 
     def __init__(self, bank, addr):
-        self.bank, self.addr = bank, addr
+        # set up by __new__
+        pass
+
+    def __reduce__(self):
+        return (Register, (self.bank, self.addr))
 
     def __str__(self):
         return f"{' abc'[self.bank]}{self.addr:02x}"
 
     def __hash__(self):
-        return hash((self.bank, self.addr))
+        return self._hash
 
     def __eq__(self, other):
-        return (self.bank, self.addr) == (other.bank, other.addr)
+        if self is other:
+            return True
+        return type(other) is Register \
+            and (self.bank, self.addr) == (other.bank, other.addr)
 
     def deps(self):
         return []
@@ -140,6 +190,8 @@ class Register(Operand):
         return str(self)
 
 class Instruction(Operand):
+    __slots__ = ("opcode", "out", "ops", "src")
+
     def __init__(self, opcode, *ops):
         self.opcode = Opcode(opcode)
         self.out = ops[0] if len(ops) else None
@@ -173,8 +225,7 @@ class Instruction(Operand):
         return Register(bank, opspecs[bank - 1])
 
     def is_float_op(self, idx):
-        # TODO
-        return self.opcode.name.startswith("F") 
+        return OPCODE_INFO[self.opcode].float_ops[idx]
 
     def encode(self):
         for op in self.ops:
@@ -190,7 +241,7 @@ class Instruction(Operand):
             opspecs[op.bank - 1] = op.addr
             opbanks[i] = op.bank
 
-        fields = GeneralInstr(0,
+        fields = GeneralInstr.from_fields(
             OPCODE1=self.opcode, OPCODE2=self.opcode >> 8,
             OP1BANK=opbanks[0], OP2BANK=opbanks[1], OP3BANK=opbanks[2],
             **({'OUTBANK': self.out.bank, 'OUTADDR': self.out.addr}
@@ -219,7 +270,7 @@ class Instruction(Operand):
 
     @property
     def has_side_effects(self):
-        return self.opcode in range(0xa0, 0xc0)
+        return OPCODE_INFO[self.opcode].side_effects != SideEffect.NONE
 
     def __str__(self):
         operand_list = ", ".join([
@@ -245,6 +296,9 @@ class Routine:
         self.instr += v
         return self
 
+    def pack(self):
+        return PackedRoutine(self)
+
     def is_selected(self, inst):
         return (inst in self.selected) if self.selected is not None else True
 
@@ -257,6 +311,116 @@ class Routine:
             else:   
                 print(f"+{off:02x}: {str(inst)}", file=f)
 
+class PackedRoutine:
+    '''
+    Compact struct-of-arrays storage of a routine. Instructions are kept
+    as an opcode column and out/op1..op3 columns indexing into a table of
+    distinct operands (or, for operands which are results of other
+    instructions of the routine, pointing to those), plus a column
+    indexing into a table of source notes. Globals go in the operand
+    table as they are, with those of their cases which are instructions
+    of the routine noted down separately by instruction index.
+
+    Use unpack() to get back a Routine to run passes on. This points
+    the noted Global cases at the unpacked instructions, so the unpacked
+    routine is to take the place of the packed one in the program.
+    '''
+    NONE = -1
+
+    def __init__(self, rout):
+        self.base = rout.base
+        self.waitfull_ports = rout.waitfull_ports
+        self.waitempty_ports = rout.waitempty_ports
+        self.rings = rout.rings
+        self.operands = []
+        self.srcs = [""]
+        self.opcodes = array("H")
+        self.columns = [array("i") for _ in range(4)]
+        self.src_column = array("i")
+        # (operand index, case position, instruction index) triplets
+        self.global_cases = []
+
+        inst_index = {id(inst): i for i, inst in enumerate(rout.instr)
+                      if inst is not None}
+        operand_index = dict()
+        src_index = {"": 0}
+
+        def ref(op):
+            if op is None:
+                return self.NONE
+            if type(op) is Instruction:
+                if id(op) not in inst_index:
+                    raise ValueError("operand refers to an instruction of another routine")
+                return -2 - inst_index[id(op)]
+            if type(op) is Register:
+                key = (Register, op.bank, op.addr)
+            elif type(op) is Constant:
+                key = (Constant, op.val)
+            else:
+                key = id(op)
+            if key not in operand_index:
+                operand_index[key] = len(self.operands)
+                self.operands.append(op)
+                if type(op) is Global:
+                    self.global_cases.extend(
+                        (operand_index[key], pos, inst_index[id(case)])
+                        for pos, case in enumerate(op.cases)
+                        if id(case) in inst_index
+                    )
+            return operand_index[key]
+
+        for inst in rout.instr:
+            if inst is None:
+                # empty slot, marked by an out-of-range opcode
+                self.opcodes.append(0xffff)
+                for col in self.columns:
+                    col.append(self.NONE)
+                self.src_column.append(0)
+                continue
+            self.opcodes.append(inst.opcode)
+            for col, op in zip(self.columns, [inst.out] + inst.ops):
+                col.append(ref(op))
+            if inst.src not in src_index:
+                src_index[inst.src] = len(self.srcs)
+                self.srcs.append(inst.src)
+            self.src_column.append(src_index[inst.src])
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def unpack(self):
+        instr = []
+        for i, opcode in enumerate(self.opcodes):
+            if opcode == 0xffff:
+                instr.append(None)
+                continue
+            inst = Instruction(opcode, *[
+                self.operands[col[i]] if col[i] >= 0 else None
+                for col in self.columns
+            ])
+            inst.src = self.srcs[self.src_column[i]]
+            instr.append(inst)
+
+        # second go for operands which are results of other instructions
+        for col_no, col in enumerate(self.columns):
+            for i, v in enumerate(col):
+                if v >= self.NONE:
+                    continue
+                if col_no == 0:
+                    instr[i].out = instr[-2 - v]
+                else:
+                    instr[i].ops[col_no - 1] = instr[-2 - v]
+
+        for opidx, pos, i in self.global_cases:
+            self.operands[opidx].cases[pos] = instr[i]
+
+        rout = Routine(self.base, instr, self.waitfull_ports, self.waitempty_ports)
+        rout.rings = self.rings
+        return rout
+
+    def dump(self, f):
+        self.unpack().dump(f)
+
 def decode_sieve(vals):
     return [
         i * 32 + bitpos
@@ -271,11 +435,184 @@ def encode_sieve(hits, length):
         ret[hit // 32] = ret[hit // 32] | 1 << (hit % 32)
     return ret
 
+def _field(field):
+    return field.shift, field.mask
+
+_OPCODE_LOOKUP = {int(opcode): opcode for opcode in Opcode}
+
+def decode_instructions(words0, words1, words2, words3):
+    '''
+    Decode a span of instructions given as the four columns of
+    INST0..INST3 words. Each field is extracted for the whole span
+    at once instead of going through GeneralInstr per instruction.
+    '''
+    shift1, mask1 = _field(GeneralInstr.OPCODE1)
+    shift2, mask2 = _field(GeneralInstr.OPCODE2)
+    opcodes = [((w >> shift1) & mask1) | (((w >> shift2) & mask2) << 8)
+               for w in words0]
+    shift, mask = _field(GeneralInstr.OUTBANK)
+    outbanks = [(w >> shift) & mask for w in words0]
+    shift, mask = _field(GeneralInstr.OUTADDR)
+    outaddrs = [(w >> shift) & mask for w in words0]
+    opbanks = []
+    for spec in [GeneralInstr.OP1BANK, GeneralInstr.OP2BANK, GeneralInstr.OP3BANK]:
+        shift, mask = _field(spec)
+        opbanks.append([(w >> shift) & mask for w in words0])
+    opspecs = [None, words1, words2, words3]
+
+    ret = []
+    for i, opcode in enumerate(opcodes):
+        if opcode not in _OPCODE_LOOKUP:
+            raise ValueError(f'instruction decode: unknown opcode {opcode:#x}')
+        ret.append(Instruction(
+            _OPCODE_LOOKUP[opcode],
+            Register(outbanks[i], outaddrs[i]) if outbanks[i] != 0 else None,
+            *[Register(banks[i], opspecs[banks[i]][i]) if banks[i] != 0 else None
+              for banks in opbanks]
+        ))
+    return ret
+
+def encode_instructions(instrs):
+    '''
+    Encode a span of instructions into the four columns of INST0..INST3
+    words (the batch counterpart of Instruction.encode).
+    '''
+    shift1, mask1 = _field(GeneralInstr.OPCODE1)
+    shift2, mask2 = _field(GeneralInstr.OPCODE2)
+    outbank_shift, outbank_mask = _field(GeneralInstr.OUTBANK)
+    outaddr_shift, outaddr_mask = _field(GeneralInstr.OUTADDR)
+    opbank_fields = [_field(GeneralInstr.OP1BANK), _field(GeneralInstr.OP2BANK),
+                     _field(GeneralInstr.OP3BANK)]
+
+    words0, words1, words2, words3 = [], [], [], []
+    for inst in instrs:
+        opcode = int(inst.opcode)
+        word = ((opcode & mask1) << shift1) | (((opcode >> 8) & mask2) << shift2)
+        if inst.out is not None:
+            word |= (inst.out.bank & outbank_mask) << outbank_shift \
+                    | (inst.out.addr & outaddr_mask) << outaddr_shift
+        opspecs = [None, None, None]
+        for op, (shift, mask) in zip(inst.ops, opbank_fields):
+            if op is None:
+                continue
+            assert type(op) is Register
+            assert opspecs[op.bank - 1] is None \
+                or opspecs[op.bank - 1] == op.addr
+            opspecs[op.bank - 1] = op.addr
+            word |= (op.bank & mask) << shift
+        words0.append(word)
+        words1.append(opspecs[0] or 0)
+        words2.append(opspecs[1] or 0)
+        words3.append(opspecs[2] or 0)
+    return words0, words1, words2, words3
+
+class RegisterFile(MutableMapping):
+    '''
+    Initial register values, kept per bank in a dense array of values
+    next to an occupancy bitmap. Behaves as a Register -> int mapping,
+    and additionally supports bulk loads and stores of address spans
+    which don't go through Register objects.
+    '''
+    BANKS = (1, 2, 3)
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._vals = {bank: array("I") for bank in self.BANKS}
+        self._occupied = {bank: bytearray() for bank in self.BANKS}
+        self._count = 0
+
+    def _grow(self, bank, end):
+        vals, occupied = self._vals[bank], self._occupied[bank]
+        if len(vals) < end:
+            vals.frombytes(bytes(vals.itemsize * (end - len(vals))))
+            occupied.extend(bytes(end - len(occupied)))
+        return vals, occupied
+
+    def __getitem__(self, reg):
+        if type(reg) is not Register or reg.bank not in self._vals:
+            raise KeyError(reg)
+        occupied = self._occupied[reg.bank]
+        if reg.addr >= len(occupied) or not occupied[reg.addr]:
+            raise KeyError(reg)
+        return self._vals[reg.bank][reg.addr]
+
+    def __setitem__(self, reg, val):
+        assert type(reg) is Register and reg.bank in self._vals
+        vals, occupied = self._grow(reg.bank, reg.addr + 1)
+        vals[reg.addr] = val
+        if not occupied[reg.addr]:
+            occupied[reg.addr] = 1
+            self._count += 1
+
+    def __delitem__(self, reg):
+        self[reg] # raises KeyError if not set
+        self._vals[reg.bank][reg.addr] = 0
+        self._occupied[reg.bank][reg.addr] = 0
+        self._count -= 1
+
+    def __iter__(self):
+        for bank in self.BANKS:
+            occupied = self._occupied[bank]
+            addr = occupied.find(1)
+            while addr >= 0:
+                yield Register(bank, addr)
+                addr = occupied.find(1, addr + 1)
+
+    def __len__(self):
+        return self._count
+
+    def span(self, bank):
+        '''
+        Return the smallest address range covering all initialized
+        registers in a bank, or None if there are none.
+        '''
+        occupied = self._occupied[bank]
+        start = occupied.find(1)
+        if start < 0:
+            return None
+        return range(start, occupied.rfind(1) + 1)
+
+    def load(self, bank, base, words, occupancy=None):
+        '''
+        Initialize a span of registers in a bank starting at address 'base'
+        from a sequence of values. If 'occupancy' is given, it's a bytes
+        object of the same length marking which of the registers are to be
+        considered initialized.
+        '''
+        end = base + len(words)
+        if occupancy is None:
+            occupancy = b"\x01" * len(words)
+        assert len(occupancy) == len(words)
+        vals, occupied = self._grow(bank, end)
+        self._count += occupancy.count(1) - occupied.count(1, base, end)
+        vals[base:end] = array("I", words)
+        occupied[base:end] = occupancy
+
+    def store(self, bank, span):
+        '''
+        Return the values of a span of registers in a bank as an array,
+        with uninitialized registers reading as zero.
+        '''
+        vals, _ = self._grow(bank, span.stop)
+        return vals[span.start:span.stop]
+
+    def occupancy(self, bank, span):
+        '''
+        Return a bytes object marking which registers in a span of a bank
+        are initialized.
+        '''
+        _, occupied = self._grow(bank, span.stop)
+        return bytes(occupied[span.start:span.stop])
+
 class Program:
     def __init__(self):
-        self.register_inits = {}
+        self.register_inits = RegisterFile()
         self.register_specials = set()
         self.register_allocated = set()
+        # (bank, value) -> register holding the constant
+        self.const_pool = {}
         self.routines = []
 
     @classmethod
@@ -284,10 +621,8 @@ class Program:
 
         for typ, span in img.section_spans(range(Section.STATE1,
                                                  Section.STATE3 + 1)):
-            bank = typ - Section.STATE0
-            for addr_delta, val in enumerate(img[typ,span]):
-                reg = Register(bank, span.start + addr_delta)
-                prg.register_inits[reg] = val
+            prg.register_inits.load(typ - Section.STATE0, span.start,
+                                    img[typ,span])
 
         enabled_routines = set()
 
@@ -307,8 +642,7 @@ class Program:
             ]
             prg.routines.append(Routine(
                 routine_span.start,
-                [Instruction.decode(*pieces)
-                 for pieces in zip(*instr_parts)]
+                decode_instructions(*instr_parts)
             ))
 
         for i, rout in enumerate(prg.routines):
@@ -321,40 +655,43 @@ class Program:
         img = Image()
 
         for secttype in range(Section.STATE1, Section.STATE3 + 1):
-            inits = { k.addr: v for k, v in self.register_inits.items() \
-                      if k.bank == secttype - Section.STATE0 }
-            if not len(inits):
+            bank = secttype - Section.STATE0
+            span = self.register_inits.span(bank)
+            if span is None:
                 continue
-            base = min(inits.keys())
-            end = max(inits.keys()) + 1
-            img.reserve(secttype, range(base, end), 0)
-            for addr, val in inits.items():
-                img[secttype, addr] = val
+            img.reserve(secttype, span, 0)
+            img[secttype, span] = self.register_inits.store(bank, span)
 
         for rout_no, rout in enumerate(self.routines):
             assert rout.base is not None
             span = range(rout.base, rout.base + len(rout.instr))
-            img.reserve(Section.INST0, span)
-            img.reserve(Section.INST1, span)
-            img.reserve(Section.INST2, span)
-            img.reserve(Section.INST3, span)
-
-            for off, inst in enumerate(rout.instr):
-                idx = rout.base + off
-                try:
-                    img[Section.INST0:Section.INST3 + 1, idx] = inst.encode()
-                except Exception as e:
-                    print("Failed to encode the following instruction:", file=sys.stderr)
-                    print(f"\t{idx}: {inst!s}", file=sys.stderr)
-                    raise e
+            img.reserve_many([
+                (Section.INST0, span), (Section.INST1, span),
+                (Section.INST2, span), (Section.INST3, span),
+            ])
+
+            try:
+                img[Section.INST0:Section.INST3 + 1, span] = \
+                        encode_instructions(rout.instr)
+            except Exception as e:
+                for off, inst in enumerate(rout.instr):
+                    try:
+                        inst.encode()
+                    except Exception:
+                        print("Failed to encode the following instruction:", file=sys.stderr)
+                        print(f"\t{rout.base + off}: {inst!s}", file=sys.stderr)
+                        break
+                raise e
 
             ctl_span = range(rout_no << 16, (rout_no << 16) + 8)
-            img.reserve(Section.ROUTINE_CTL, ctl_span, SectionFlags.ROUTINE_EN)
+            sieves_span = range(rout_no << 16, (rout_no << 16) + 4)
+            img.reserve_many([
+                (Section.ROUTINE_CTL, ctl_span, SectionFlags.ROUTINE_EN),
+                (Section.WE_SIEVE, sieves_span),
+                (Section.WF_SIEVE, sieves_span),
+            ])
             img[Section.ROUTINE_CTL, rout_no << 16 | 2] = span.start | (span.stop << 16)
 
-            sieves_span = range(rout_no << 16, (rout_no << 16) + 4)
-            img.reserve(Section.WE_SIEVE, sieves_span)
-            img.reserve(Section.WF_SIEVE, sieves_span)
             img[Section.WE_SIEVE, sieves_span] = encode_sieve(rout.waitempty_ports, 4)
             img[Section.WF_SIEVE, sieves_span] = encode_sieve(rout.waitfull_ports, 4)
 
@@ -366,14 +703,32 @@ class Program:
             r.dump(f)
 
 class RegAllocator:
+    '''
+    Hands out registers of a bank which are not in 'mask', preferring
+    the lowest-addressed of those given back by free(). Keeps track of
+    the peak number of registers handed out at the same time.
+    '''
     def __init__(self, bank, mask):
         self.bank = bank
         self.next_free = 0
         self.mask = mask
+        self.freed = []
+        self.live = 0
+        self.peak = 0
 
     def __call__(self):
-        reg = Register(self.bank, self.next_free)
-        while reg in self.mask:
-            reg = Register(reg.bank, reg.addr + 1)
-        self.next_free = reg.addr + 1
+        if len(self.freed):
+            reg = Register(self.bank, heapq.heappop(self.freed))
+        else:
+            reg = Register(self.bank, self.next_free)
+            while reg in self.mask:
+                reg = Register(reg.bank, reg.addr + 1)
+            self.next_free = reg.addr + 1
+        self.live += 1
+        self.peak = max(self.peak, self.live)
         return reg
+
+    def free(self, reg):
+        assert reg.bank == self.bank
+        heapq.heappush(self.freed, reg.addr)
+        self.live -= 1
@@ -0,0 +1,218 @@
+'''
+Snapshots of Programs at pass boundaries.
+
+A snapshot is a pickle of plain tuples, lists and numbers prefixed by
+a short header. Operands and rings are numbered sequentially in the
+order they are first met walking the program, and references between
+them are by those numbers, so the snapshot of a given program doesn't
+depend on where in memory its objects happen to live. The loader
+refuses to unpickle anything but builtin containers.
+'''
+import io
+import pickle
+import struct
+
+from .program import *
+
+SNAPSHOT_MAGIC = b"LEAPSNAP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sI")
+
+OBJ_REGISTER      = 0
+OBJ_CONSTANT      = 1
+OBJ_INSTRUCTION   = 2
+OBJ_GLOBAL        = 3
+OBJ_RING          = 4
+OBJ_RING_OPERAND  = 5
+OBJ_UNINITIALIZED = 6
+OBJ_BAD_OPERAND   = 7
+
+class _Numbering:
+    def __init__(self):
+        self.ids = dict()
+        self.objects = []
+
+    def __call__(self, obj):
+        if obj is None:
+            return None
+        # Registers and Constants are interned so keying by identity
+        # dedups them too
+        key = id(obj)
+        if key in self.ids:
+            return self.ids[key]
+        idx = len(self.objects)
+        self.ids[key] = idx
+        self.objects.append(obj)
+        return idx
+
+def _encode_object(obj, ref):
+    if type(obj) is Register:
+        return (OBJ_REGISTER, obj.bank, obj.addr)
+    elif type(obj) is Constant:
+        return (OBJ_CONSTANT, obj.val)
+    elif type(obj) is Instruction:
+        return (OBJ_INSTRUCTION, int(obj.opcode), ref(obj.out),
+                tuple(ref(op) for op in obj.ops), obj.src)
+    elif type(obj) is Global:
+        return (OBJ_GLOBAL, tuple(ref(case) for case in obj.cases),
+                ref(obj.out))
+    elif type(obj) is RegisterRing:
+        base = obj.addrspan.start if obj.addrspan is not None else None
+        return (OBJ_RING, obj.depth, obj.width, obj.bank, base)
+    elif type(obj) is RingOperand:
+        return (OBJ_RING_OPERAND, ref(obj.ring), obj.offset)
+    elif type(obj) is Uninitialized:
+        return (OBJ_UNINITIALIZED,)
+    elif type(obj) is BadOperand:
+        return (OBJ_BAD_OPERAND,)
+    else:
+        raise ValueError(f"cannot snapshot object {obj!r}")
+
+def _encode_regs(regs):
+    return sorted((reg.bank, reg.addr) for reg in regs)
+
+def encode(prg):
+    '''
+    Convert a program into a snapshot tree of plain values.
+    '''
+    ref = _Numbering()
+
+    instr = [[ref(inst) for inst in rout.instr] for rout in prg.routines]
+    rings = [[ref(ring) for ring in rout.rings] for rout in prg.routines]
+
+    # Encoding an object may number further objects it refers to,
+    # which get appended to the list as we go
+    objects = []
+    def encode_numbered():
+        while len(objects) < len(ref.objects):
+            objects.append(_encode_object(ref.objects[len(objects)], ref))
+    encode_numbered()
+
+    # Selections are sets, so only number them now that everything
+    # reachable from the routines has been numbered in a fixed order
+    selected = [sorted(ref(inst) for inst in rout.selected) \
+                    if rout.selected is not None else None
+                for rout in prg.routines]
+    encode_numbered()
+
+    routines = [
+        (rout.base, rout_instr, rout_selected, list(rout.waitfull_ports),
+         list(rout.waitempty_ports), rout_rings)
+        for rout, rout_instr, rout_selected, rout_rings
+        in zip(prg.routines, instr, selected, rings)
+    ]
+
+    inits = []
+    for bank in RegisterFile.BANKS:
+        span = prg.register_inits.span(bank)
+        if span is None:
+            continue
+        inits.append((bank, span.start,
+                      list(prg.register_inits.store(bank, span)),
+                      prg.register_inits.occupancy(bank, span)))
+
+    return (
+        objects,
+        routines,
+        inits,
+        _encode_regs(prg.register_specials),
+        _encode_regs(prg.register_allocated),
+        sorted((bank, val, reg.addr) for (bank, val), reg
+               in prg.const_pool.items()),
+    )
+
+def decode(tree):
+    '''
+    Convert a snapshot tree back into a program.
+    '''
+    objects, routines, inits, specials, allocated, const_pool = tree
+
+    # First create all objects, then fill them in, as there can be
+    # reference loops (e.g. through Globals)
+    made = []
+    for entry in objects:
+        kind = entry[0]
+        if kind == OBJ_REGISTER:
+            made.append(Register(entry[1], entry[2]))
+        elif kind == OBJ_CONSTANT:
+            made.append(Constant(entry[1]))
+        elif kind == OBJ_INSTRUCTION:
+            made.append(Instruction(Opcode(entry[1])))
+        elif kind == OBJ_GLOBAL:
+            made.append(Global())
+        elif kind == OBJ_RING:
+            made.append(RegisterRing(*entry[1:]))
+        elif kind == OBJ_RING_OPERAND:
+            made.append(None) # filled in once all rings exist
+        elif kind == OBJ_UNINITIALIZED:
+            made.append(Uninitialized())
+        elif kind == OBJ_BAD_OPERAND:
+            made.append(BadOperand())
+        else:
+            raise ValueError(f"bad snapshot object kind {kind!r}")
+
+    def deref(idx):
+        return made[idx] if idx is not None else None
+
+    for idx, entry in enumerate(objects):
+        if entry[0] == OBJ_RING_OPERAND:
+            made[idx] = RingOperand(made[entry[1]], entry[2])
+
+    for obj, entry in zip(made, objects):
+        if entry[0] == OBJ_INSTRUCTION:
+            obj.out = deref(entry[2])
+            obj.ops = [deref(op) for op in entry[3]]
+            obj.src = entry[4]
+        elif entry[0] == OBJ_GLOBAL:
+            obj.cases = [deref(case) for case in entry[1]]
+            obj.out = deref(entry[2])
+
+    prg = Program()
+    for base, instr, selected, waitfull, waitempty, rings in routines:
+        rout = Routine(base, [deref(inst) for inst in instr],
+                       waitfull, waitempty)
+        if selected is not None:
+            rout.selected = set(made[idx] for idx in selected)
+        rout.rings = [made[idx] for idx in rings]
+        prg.routines.append(rout)
+
+    for bank, base, vals, occupied in inits:
+        prg.register_inits.load(bank, base, vals, occupied)
+
+    prg.register_specials = set(Register(b, a) for b, a in specials)
+    prg.register_allocated = set(Register(b, a) for b, a in allocated)
+    prg.const_pool = {
+        (bank, val): Register(bank, addr) for bank, val, addr in const_pool
+    }
+
+    return prg
+
+class _PlainUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"unexpected object {module}.{name} in snapshot")
+
+def write(prg, f):
+    '''
+    Write a snapshot of a program to a file object.
+    '''
+    f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+    pickle.dump(encode(prg), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def read(f):
+    '''
+    Read a program back from a snapshot in a file object.
+    '''
+    magic, version = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("not a program snapshot")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"unsupported snapshot version {version}")
+    return decode(_PlainUnpickler(f).load())
+
+def dumps(prg):
+    f = io.BytesIO()
+    write(prg, f)
+    return f.getvalue()
+
+def loads(data):
+    return read(io.BytesIO(data))
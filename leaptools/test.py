@@ -1,9 +1,28 @@
+import contextlib
+import io
+import itertools
+import os
+import pickle
+import tempfile
 import unittest
 from construct import hexundump
 
 from .program import *
-from .image import Image, Section
+from .image import Image, Bundle, Section, hexdump, \
+                   LEAPFROGImage, LEAPFROGPatch, LEAPFROGBundle
 from .dsl import Builder
+from . import snapshot
+from . import passes
+
+@contextlib.contextmanager
+def port_routine(prg):
+    '''
+    Add a routine woken up by port 0x41 to the program, giving a builder
+    for it and a first value taken from the port.
+    '''
+    b = Builder(prg)
+    with b.Routine(waitfull_ports=[0x41]):
+        yield b, b.TAKE(0x41_000000)
 
 class TestInstruction(unittest.TestCase):
     def test_encoding(self):
@@ -18,6 +37,387 @@ class TestInstruction(unittest.TestCase):
                 Instruction.decode(*case).encode()
             )
 
+    def test_interning(self):
+        self.assertIs(Register(2, 0x10), Register.parse("b10"))
+        self.assertIs(Constant(0.5), Constant.from_float(0.5))
+        self.assertIsNot(Constant(1), Constant(2))
+        self.assertNotEqual(Register(1, 0), None)
+
+    def test_opcode_info(self):
+        self.assertEqual(OPCODE_INFO[Opcode.FMULTACC].spacing, 1)
+        self.assertEqual(OPCODE_INFO[Opcode.FMULT].spacing, 0)
+        self.assertEqual(OPCODE_INFO[Opcode.TAKE].side_effects,
+                         SideEffect.PORT_READ)
+        self.assertFalse(OPCODE_INFO[Opcode.ADD].has_side_effects)
+        self.assertEqual(OPCODE_INFO[Opcode.FMUX].float_ops,
+                         (True, True, False))
+        self.assertEqual(OPCODE_INFO[Opcode.FRACMULT].float_ops,
+                         (False, False, False))
+        self.assertEqual(OPCODE_INFO[Opcode.FMULTSUB].float_ops,
+                         (True, True, True))
+        self.assertEqual(OPCODE_INFO[Opcode.PUT].sieve, (True, False, True))
+        self.assertIs(OPCODE_INFO[int(Opcode.PEEK)].opcode, Opcode.PEEK)
+
+    def test_bitfields(self):
+        fields = GeneralInstr(0xbaded8).to_fields()
+        self.assertEqual(fields["OPCODE1"], 0xd8)
+        self.assertEqual(fields["OUTADDR"], 0x17)
+        self.assertEqual(int(GeneralInstr.from_fields(**fields)), 0xbaded8)
+
+        instr = GeneralInstr(0xbaded8)
+        instr.OUTBANK = 0
+        self.assertEqual(int(instr), 0xba1ed8)
+
+    def test_batch_encoding(self):
+        columns = ([0x22f4c6, 0xa7e5, 0xbaded8], [2, 6, 51],
+                   [0, 13, 22], [0, 5, 52])
+        instrs = decode_instructions(*columns)
+        self.assertEqual([str(inst) for inst in instrs],
+                         [str(Instruction.decode(*case)) for case in zip(*columns)])
+        self.assertEqual(encode_instructions(instrs), columns)
+
+class TestPackedRoutine(unittest.TestCase):
+    def test_pack_unpack(self):
+        prg = Program()
+        with port_routine(prg) as (b, val):
+            b.PUT(b.FMULTACC(val, val, 0.5), 0x40_000000)
+
+        packed = prg.routines[0].pack()
+        self.assertEqual(len(packed), 3)
+        instr = packed.unpack().instr
+        self.assertEqual([i.opcode for i in instr],
+                         [i.opcode for i in prg.routines[0].instr])
+        self.assertEqual(instr[1].op3.val, prg.routines[0].instr[1].op3.val)
+        self.assertIs(instr[1].op1, instr[0])
+        self.assertIs(instr[2].op1, instr[1])
+        self.assertEqual(packed.waitfull_ports, [0x41])
+
+    def test_pack_dsl_routines(self):
+        fname = os.path.join(os.path.dirname(__file__), "..",
+                             "firmware", "leapmic", "leap_firmware.py")
+        def compile(repack):
+            prg = Program()
+            passes.load_dsl(prg, fname)
+            if repack:
+                prg.routines = [rout.pack().unpack() for rout in prg.routines]
+            # Global cases must point at the unpacked instructions
+            instr = [inst for rout in prg.routines for inst in rout.instr]
+            for inst in instr:
+                for op in inst.ops:
+                    if type(op) is not Global:
+                        continue
+                    for case in op.cases:
+                        if type(case) is Instruction:
+                            self.assertTrue(any(case is i for i in instr))
+            passes.place(prg)
+            passes.regalloc_intermediate(prg)
+            passes.propagate_outs(prg)
+            passes.regalloc_const(prg)
+            passes.set_nops(prg)
+            passes.arrange_routines(prg)
+            return bytes(prg.build_image())
+
+        self.assertEqual(compile(True), compile(False))
+
+class TestSnapshot(unittest.TestCase):
+    def test_roundtrip(self):
+        prg = Program()
+        acc = Global(init=0.0)
+        with port_routine(prg) as (b, val):
+            acc.cases.append(b.FMULTACC(acc, val, 0.5))
+            b.PUT(acc, 0x40_000000)
+        prg.register_inits[Register(1, 3)] = 0xbeef
+
+        data = snapshot.dumps(prg)
+        restored = snapshot.loads(data)
+        self.assertEqual(snapshot.dumps(restored), data)
+
+        instr = restored.routines[0].instr
+        self.assertEqual([i.opcode for i in instr],
+                         [i.opcode for i in prg.routines[0].instr])
+        acc = instr[1].op1
+        self.assertIs(type(acc), Global)
+        self.assertIs(acc.cases[1], instr[1])
+        self.assertEqual(restored.routines[0].waitfull_ports, [0x41])
+        self.assertEqual(dict(restored.register_inits), {Register(1, 3): 0xbeef})
+
+    def test_selection(self):
+        def build():
+            prg = Program()
+            with port_routine(prg) as (b, x):
+                vals = [b.ADD(x, i) for i in range(8)]
+            with port_routine(prg) as (b, y):
+                for val in vals:
+                    y = b.FADD_DIV2(y, b.FMULT(val, 0.5))
+                b.PUT(y, 0x40_000000)
+            passes.select(prg, 1, len(prg.routines[1].instr) - 1)
+            return prg
+
+        # the selection holds constants and instructions of the other
+        # routine, whose numbering mustn't depend on set order
+        self.assertEqual(len(set(snapshot.dumps(build()) for _ in range(8))), 1)
+
+    def test_plain_only(self):
+        evil = snapshot.SNAPSHOT_HEADER.pack(snapshot.SNAPSHOT_MAGIC,
+                                             snapshot.SNAPSHOT_VERSION) \
+                + pickle.dumps(Program())
+        with self.assertRaises(pickle.UnpicklingError):
+            snapshot.loads(evil)
+
+class TestPlacement(unittest.TestCase):
+    def build(self):
+        prg = Program()
+        with port_routine(prg) as (b, val):
+            x = b.FMULTACC(val, val, 0.5)
+            x = b.FMULTACC(x, x, 0.5)
+            x = b.FMULTACC(x, x, 0.5)
+            y = b.ADD(val, 1)
+            y = b.ADD(y, 2)
+            b.PUT(x, 0x40_000000)
+            b.PUT(y, 0x40_000000)
+        return prg
+
+    def check(self, prg):
+        rout = prg.routines[0]
+        pos = {inst: i for i, inst in enumerate(rout.instr)}
+        for endp, base, offset, _, _ in \
+                passes.get_placement_constraints(prg, rout):
+            self.assertGreater(pos[endp], pos[base] + offset)
+
+    def test_list_scheduling(self):
+        prg = self.build()
+        passes.place_routine(prg, 0)
+        self.check(prg)
+        # the ADD chain fills the FMULTACC latency slots, save for one
+        # before the first PUT (naive placement needs three NOPs)
+        self.assertEqual(prg.routines[0].instr.count(None), 1)
+
+    def test_optimal_placement(self):
+        prg = self.build()
+        rout = prg.routines[0]
+        constraints = passes.get_placement_constraints(prg, rout)
+        placed = passes._schedule_sat(rout, constraints, 100, 10.0)
+        self.assertEqual(len(placed), 9)
+        # nothing shorter than 9 slots exists
+        self.assertIsNone(passes._schedule_sat(rout, constraints, 9, 10.0))
+
+        passes.place_routine(prg, 0, "optimal")
+        self.check(prg)
+        self.assertEqual(len(rout.instr), 9)
+
+    def test_long_latency(self):
+        # the LIFO baseline gets stuck on latencies above 2, which
+        # mustn't keep the routine from being placed
+        info = OPCODE_INFO[Opcode.FMULTACC]
+        latency, info.latency = info.latency, 3
+        try:
+            prg = self.build()
+            passes.place_routine(prg, 0)
+            self.check(prg)
+        finally:
+            info.latency = latency
+
+class TestOptimizations(unittest.TestCase):
+    def test_cse(self):
+        prg = Program()
+        acc = Global(init=0.0)
+        with port_routine(prg) as (b, x):
+            y = b.TAKE(0x41_000000)
+            a1 = b.FMULT(b.FSUB(x, acc), 0.5)
+            a2 = b.FMULT(b.FSUB(x, acc), 0.5)
+            b.update(acc, a1)
+            b.update(acc, a1)
+            b.PUT(b.FADD_DIV2(a1, a2), 0x40_000000)
+            b.PUT(b.FADD_DIV2(y, a2), 0x40_000000)
+
+        self.assertEqual(passes._min_slots(prg, prg.routines[0]), 12)
+        passes.cse(prg)
+        instr = prg.routines[0].instr
+        # the second FSUB and FMULT are gone, the TAKEs and global
+        # updates stay
+        self.assertEqual(len(instr), 10)
+        self.assertEqual(passes._min_slots(prg, prg.routines[0]), 10)
+        self.assertEqual([i.opcode for i in instr].count(Opcode.TAKE), 2)
+        self.assertEqual(len(acc.cases), 3)
+        fadd = [i for i in instr if i.opcode == Opcode.FADD_DIV2]
+        self.assertIs(fadd[0].op1, fadd[0].op2)
+        self.assertIs(fadd[1].op2, fadd[0].op1)
+
+    def test_dce(self):
+        prg = Program()
+        acc, unused = Global(init=0.0), Global(init=0.0)
+        with port_routine(prg) as (b, x):
+            b.FMULT(b.FSUB(x, unused), 0.5)
+            b.update(acc, b.FADD_DIV2(acc, x))
+            b.PUT(acc, 0x40_000000)
+            b.PEEK(0x41_000000)
+
+        passes.dce(prg)
+        self.assertEqual([i.opcode for i in prg.routines[0].instr], [
+            Opcode.TAKE, Opcode.FADD_DIV2, Opcode.OR,
+            Opcode.PUT, Opcode.PEEK,
+        ])
+
+    def test_dce_placed(self):
+        prg = Program()
+        with port_routine(prg) as (b, x):
+            y = b.FMULTACC(x, x, 0.5)
+            b.PUT(y, 0x40_000000)
+            b.ADD(y, 1)
+        passes.place(prg)
+        self.assertEqual(prg.routines[0].instr.count(None), 1)
+        nslots = len(prg.routines[0].instr)
+
+        # the dead ADD leaves an empty slot behind
+        passes.dce(prg)
+        self.assertEqual(len(prg.routines[0].instr), nslots)
+        self.assertEqual(prg.routines[0].instr.count(None), 2)
+
+        passes.regalloc_intermediate(prg)
+        passes.propagate_outs(prg)
+        passes.regalloc_const(prg)
+        passes.set_nops(prg)
+        passes.arrange_routines(prg)
+
+        # nor is the NOP filling it taken for dead code
+        loaded = Program.from_image(prg.build_image())
+        passes.dce(loaded)
+        self.assertEqual([i.opcode for i in loaded.routines[0].instr],
+                         [i.opcode for i in prg.routines[0].instr])
+
+    def test_constant_folding(self):
+        prg = Program()
+        acc = Global(init=0.0)
+        with port_routine(prg) as (b, x):
+            a = b.FMULT(b.FSUB(0.25, 1.0), 3.0)
+            c = b.FADD_DIV2(1.0, 2.0**-24)
+            n = b.SUB(1, b.ADD(b.XOR(0xff, 0x0f), 2))
+            b.update(acc, b.OR(0, 0))
+            b.PUT(b.FADD_DIV2(a, x), 0x40_000000)
+            b.PUT(b.FMULT(c, 2.0**-126), 0x40_000000)
+            b.PUT(b.ADD(n, b.ADD(0x7fffffff, 1)), 0x40_000000)
+            b.PUT(acc, 0x40_000000)
+            b.PUT(b.FMULT(0.0, -1.0), 0x40_000000)
+
+        passes.fold_constants(prg)
+        instr = prg.routines[0].instr
+        self.assertEqual([i.opcode for i in instr], [
+            Opcode.TAKE, Opcode.OR, Opcode.FADD_DIV2, Opcode.PUT,
+            Opcode.FMULT, Opcode.PUT, Opcode.ADD, Opcode.ADD, Opcode.PUT,
+            Opcode.PUT, Opcode.FMULT, Opcode.PUT,
+        ])
+        # (1.0 - 0.25) * 3.0
+        self.assertIs(instr[2].op1, Constant(2.25))
+        # rounded to even in float32, where a double would give 0.50000003
+        self.assertIs(instr[4].op2, Constant(0.5))
+        # 2.0**-127 would be denormal, and the overflowing ADD stays
+        self.assertIs(instr[7].op1, Constant(0xf1))
+        self.assertIs(type(instr[7].op2), Instruction)
+        # a negative zero result isn't folded
+        self.assertIs(instr[10].op3, Constant(-1.0))
+
+class TestRegalloc(unittest.TestCase):
+    def test_register_reuse(self):
+        prg = Program()
+        with port_routine(prg) as (b, x):
+            for _ in range(8):
+                x = b.ADD(x, b.TAKE(0x41_000000))
+            b.PUT(x, 0x40_000000)
+        passes.place_routine(prg, 0)
+        passes.regalloc_intermediate(prg, 0)
+        rout = prg.routines[0]
+
+        # no register gets overwritten between a result being
+        # produced and its last use
+        for idx, inst in enumerate(rout.instr):
+            for use_idx, user in enumerate(rout.instr):
+                if user is None or inst not in user.ops:
+                    continue
+                for other in rout.instr[idx + 1:use_idx]:
+                    self.assertIsNot(getattr(other, "out", None), inst.out)
+
+        outs = set(inst.out for inst in rout.instr if inst.out is not None)
+        # 17 results, but never more than a handful live at once
+        self.assertLess(len(outs), 8)
+
+    def test_reuse_across_routines(self):
+        prg = Program()
+        with port_routine(prg) as (b, x):
+            y = b.ADD(x, 1)
+            for _ in range(4):
+                y = b.ADD(y, 1)
+            b.PUT(y, 0x40_000000)
+        with port_routine(prg) as (b, _):
+            b.PUT(b.ADD(x, 2), 0x40_000000)
+        # the routine reading 'x' gets allocated first
+        prg.routines.reverse()
+        passes.place(prg)
+        passes.regalloc_intermediate(prg)
+
+        # 'x' is read by the other routine, so its register must
+        # not be taken over by later results
+        self.assertTrue(all(inst.out is not x.out
+                            for inst in prg.routines[1].instr
+                            if inst is not None and inst is not x))
+
+    def test_constant_pool(self):
+        prg = Program()
+        for _ in range(2):
+            with port_routine(prg) as (b, x):
+                x = b.FMULT(x, 0.5)
+                x = b.FADD_DIV2(x, 0.5)
+                x = b.ADD(1, 1)
+                b.PUT(x, 0x40_000000)
+        passes.place(prg)
+        passes.regalloc_intermediate(prg)
+        passes.propagate_outs(prg)
+        passes.regalloc_const(prg)
+
+        # twelve constant operands, of four distinct values
+        self.assertEqual(len(set(val for _, val in prg.const_pool)), 4)
+        self.assertEqual(len(prg.register_inits), len(prg.const_pool))
+        self.assertLessEqual(len(prg.const_pool), 5)
+        for rout in prg.routines:
+            for inst in rout.instr:
+                inst.encode()
+
+        restored = snapshot.loads(snapshot.dumps(prg))
+        self.assertEqual(restored.const_pool, prg.const_pool)
+
+    def test_bank_assignment(self):
+        # a hub joined to a four-node cycle needs all three banks
+        edges = [(0, i) for i in range(1, 5)] + \
+                [(i, i % 4 + 1) for i in range(1, 5)]
+        edges = tuple(sorted(tuple(sorted(e)) for e in edges))
+        banks = passes._assign_banks(5, edges)
+        self.assertEqual(sorted(set(banks)), [0, 1, 2])
+        for a, b in edges:
+            self.assertNotEqual(banks[a], banks[b])
+        self.assertEqual(passes._color_banks(5, edges), list(banks))
+
+        k4 = tuple(itertools.combinations(range(4), 2))
+        self.assertIsNone(passes._color_banks(4, k4))
+        with self.assertRaises(RuntimeError):
+            passes._assign_banks(4, k4)
+
+class TestRegisterFile(unittest.TestCase):
+    def test_mapping(self):
+        regs = RegisterFile()
+        regs[Register(2, 5)] = 0xdead
+        regs.load(1, 3, [1, 2, 3])
+        regs[Register(1, 4)] = 7
+        self.assertEqual(len(regs), 4)
+        self.assertEqual(list(regs.items()), [
+            (Register(1, 3), 1), (Register(1, 4), 7),
+            (Register(1, 5), 3), (Register(2, 5), 0xdead),
+        ])
+        self.assertNotIn(Register(2, 4), regs)
+        self.assertEqual(regs.span(2), range(5, 6))
+        self.assertIsNone(regs.span(3))
+        del regs[Register(1, 4)]
+        self.assertEqual(list(regs.store(1, range(3, 6))), [1, 0, 3])
+        self.assertEqual(len(regs), 3)
+
 class TestImage(unittest.TestCase):
     def test_image(self):
         img = Image()
@@ -37,6 +437,60 @@ class TestImage(unittest.TestCase):
         self.assertEqual(img[Section.INST1, 0x1021], 0x00)
         self.assertEqual(img[Section.INST1, 0x1022], 0x11)
 
+    def test_cross_section_span(self):
+        img = Image()
+        img.reserve(Section.INST0, range(0x100, 0x180))
+        img.reserve(Section.INST0, range(0x0, 0x100))
+        img.reserve(Section.INST0, range(0x200, 0x280))
+
+        img[Section.INST0, 0xf0:0x110] = list(range(0x20))
+        self.assertEqual(img[Section.INST0, range(0xee, 0x112)],
+                         [0, 0] + list(range(0x20)) + [0, 0])
+        self.assertEqual(img[Section.INST0, [0xff, 0x100, 0x101]], [0xf, 0x10, 0x11])
+        img[Section.INST0, [0x0, 0x17f]] = [1, 2]
+        self.assertEqual(img[Section.INST0, [0x0, 0x17f]], [1, 2])
+        # runs of consecutive addresses, in any order and across sections
+        addrs = [0x201, 0x202, 0xfe, 0xff, 0x100, 0x101, 0x5]
+        img[Section.INST0, addrs] = list(range(7))
+        self.assertEqual(img[Section.INST0, addrs], list(range(7)))
+        self.assertEqual(img[Section.INST0, 0x200:0x204], [0, 0, 1, 0])
+        with self.assertRaises(ValueError):
+            img[Section.INST0, [0x0, 0x1]] = [1]
+
+        with self.assertRaises(IndexError):
+            img[Section.INST0, 0x170:0x210]
+
+    def test_incremental_index(self):
+        img = Image()
+        img.reserve(Section.INST2, range(0x400, 0x500))
+        img.reserve(Section.INST0, range(0x100, 0x200))
+        # fewer new sections than indexed ones, inserted one by one
+        img.reserve_many([(Section.INST1, range(0x0, 0x80)),
+                          (Section.INST0, range(0x0, 0x100), 1)])
+        # more new sections than indexed ones, the index gets re-sorted
+        img.reserve_many([(Section.INST2, range(0x0 + i * 0x40, (i + 1) * 0x40))
+                          for i in reversed(range(8))])
+        img.reserve(Section.INST1, range(0x1000, 0x1010))
+
+        for i, sect in enumerate(img.sections):
+            img[sect.type, sect.load_base] = i
+        self.assertEqual(img.sections[3].flags, 1)
+
+        rebuilt = Image()
+        rebuilt.sections = img.sections
+        rebuilt.index()
+        self.assertEqual([entry[:2] for entry in img.bases],
+                         [entry[:2] for entry in rebuilt.bases])
+        self.assertEqual(img.section_spans(), rebuilt.section_spans())
+        for sect in img.sections:
+            for addr in [sect.load_base, sect.load_base + sect.size - 1]:
+                self.assertIs(img._lookup_section(sect.type, addr),
+                              rebuilt._lookup_section(sect.type, addr))
+                self.assertIs(img._lookup_section(sect.type, addr), sect)
+        self.assertEqual(img[Section.INST2, [0x0, 0x1c0, 0x400]], [11, 4, 0])
+        self.assertEqual(img[Section.INST0, 0xff:0x101], [0, 1])
+        self.assertNotIn((Section.INST1, 0x80), img)
+
 class TestProgramImage(unittest.TestCase):
     IMAGE = hexundump("""
 0000   08 F1 A9 1E 00 00 00 00 00 00 00 00 00 00 00 00   ................
@@ -90,5 +544,103 @@ class TestProgramImage(unittest.TestCase):
         img_redone = prg.build_image()
         self.assertEqual(bytes(img_redone), bytes(img))
 
+    def test_native_serializer(self):
+        img = Image.read(self.IMAGE)
+        img.reserve(0x40000, range(0x10, 0x13), 1)
+        img.reserve(Section.IO_INIT, range(0x10, 0x13))
+        img[Section.IO_INIT, 0x10:] = [0xffffffff, 0, 0x1ea9f108]
+        self.assertEqual(bytes(img), LEAPFROGImage.build(img.content))
+        self.assertEqual(bytes(Image.map(self.IMAGE)), self.IMAGE)
+
+    def test_diff_and_patch(self):
+        base = Image.read(self.IMAGE)
+        new = Image.read(self.IMAGE)
+        new[Section.INST0, 3] ^= 0x100
+        new.reserve(Section.IO_INIT, range(0x10, 0x14))
+        new[Section.IO_INIT, 0x12] = 0xc9
+        new.imprint = "patched"
+
+        patch = LEAPFROGPatch.build(base.diff(new))
+        self.assertLess(len(patch), len(bytes(new)) // 2)
+        self.assertEqual(bytes(base.patched(patch)), bytes(new))
+        with self.assertRaises(ValueError):
+            new.patched(patch)
+
+    def test_digests(self):
+        img = Image.read(self.IMAGE)
+        prev = Image.map(self.IMAGE)
+        self.assertEqual(img.digest, prev.digest)
+
+        img[Section.INST1, 2] += 1
+        self.assertNotEqual(img.digest, prev.digest)
+        status = [st for _, st in img.changed_sections(prev)]
+        self.assertEqual(status.count("changed"), 1)
+        self.assertEqual(status.count("new"), 0)
+
+    def test_dumps(self):
+        self.assertEqual(hexundump(hexdump(self.IMAGE, 16), 16), self.IMAGE)
+
+        img = Image.read(self.IMAGE)
+        f = io.StringIO()
+        img.dump(f, types=[Section.INST1], span=range(1, 3))
+        self.assertEqual(f.getvalue().split("\n")[1:],
+                         ["\t000 000 ", ""])
+
+    def test_bundle(self):
+        variant = Image.read(self.IMAGE)
+        variant[Section.INST0, 3] ^= 0x100
+        bundle = Bundle()
+        bundle["a"] = Image.read(self.IMAGE)
+        bundle["b"] = variant
+
+        data = bytes(bundle)
+        parsed = LEAPFROGBundle.parse(data)
+        distinct = set(tuple(sect.data) for sect in bundle["a"].sections)
+        self.assertEqual(parsed.nblobs, len(distinct) + 1)
+
+        bundle = Bundle.read(data)
+        self.assertEqual(bytes(bundle["a"]), self.IMAGE)
+        self.assertEqual(bytes(bundle["b"]), bytes(variant))
+        bundle["a"][Section.INST1, 2] = 0x123
+        self.assertEqual(bytes(bundle["b"]), bytes(variant))
+
+    def test_mapped_image(self):
+        img = Image.read(self.IMAGE)
+        mapped = Image.map(self.IMAGE)
+        self.assertEqual(mapped.imprint, img.imprint)
+        for sect in img.sections:
+            span = range(sect.load_base, sect.load_base + sect.size)
+            self.assertEqual(mapped[sect.type, span], img[sect.type, span])
+        self.assertEqual(bytes(Program.from_image(mapped).build_image()),
+                         self.IMAGE)
+
+        # writes go into a private copy, not the caller's buffer
+        buf = bytearray(self.IMAGE)
+        mapped = Image.map(buf)
+        mapped[Section.INST1, 2] = 5
+        self.assertEqual(mapped[Section.INST1, 2], 5)
+        mapped[Section.INST1, [4, 5, 3]] = [6, 7, 8]
+        self.assertEqual(mapped[Section.INST1, 2:6], [5, 8, 6, 7])
+        self.assertEqual(buf, self.IMAGE)
+
+    def test_rewrite_mapped_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "image.bin")
+            with open(fname, "wb") as f:
+                f.write(self.IMAGE)
+            img = Image.map(fname)
+            img[Section.INST1, 2] = 5
+            img.write(fname)
+            self.assertEqual(Image.read(fname)[Section.INST1, 2], 5)
+
+    def test_lazy_image(self):
+        img = Image.read(self.IMAGE, lazy=True)
+        self.assertEqual(img.materialized, [])
+        self.assertEqual(img[Section.ROUTINE_CTL, 2], 0xa0000)
+        self.assertEqual([img.sections[i].type for i in img.materialized],
+                         [Section.ROUTINE_CTL])
+        prg = Program.from_image(img)
+        self.assertEqual(bytes(prg.build_image()), self.IMAGE)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,33 +1,68 @@
 from enum import IntEnum
 
-class BitFieldsValue:
-    def __init__(self, val, **kwargs):
-        l = []
-        self._fieldnames = l
-        self._fieldmask = 0
-        for cls in self.__class__.mro():
-            l += [k for k in cls.__dict__.keys() \
-                  if not k.startswith("_")]
-        for field in l:
-            top, bot = getattr(self.__class__, field)
-            self._fieldmask |= (-1 << (top + 1)) ^ (-1 << bot)
+class BitField:
+    '''
+    A field spanning bits 'top' down to 'bot' (inclusive) of a BitFieldsValue,
+    with the shift and mask precomputed.
+    '''
+    __slots__ = ("top", "bot", "shift", "mask")
+
+    def __init__(self, top, bot):
+        self.top, self.bot = top, bot
+        self.shift = bot
+        self.mask = (1 << (top - bot + 1)) - 1
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        return (obj._val >> self.shift) & self.mask
+
+    def __set__(self, obj, v):
+        obj._val = (obj._val & ~(self.mask << self.shift)) \
+                    | ((v & self.mask) << self.shift)
+
+class _BitFieldsMeta(type):
+    '''
+    Turns the (top, bot) class attributes of a BitFieldsValue subclass into
+    BitField descriptors at class creation, and gives the class empty slots.
+    '''
+    def __new__(mcls, name, bases, ns):
+        fields = dict()
+        for base in reversed(bases):
+            fields.update(getattr(base, "_fields", {}))
+        for k, v in list(ns.items()):
+            if k.startswith("_") or type(v) is not tuple:
+                continue
+            ns[k] = fields[k] = BitField(*v)
+        ns.setdefault("__slots__", ())
+        cls = super().__new__(mcls, name, bases, ns)
+        cls._fields = fields
+        cls._fieldnames = list(fields.keys())
+        cls._fieldmask = 0
+        for field in fields.values():
+            cls._fieldmask |= field.mask << field.shift
+        return cls
+
+class BitFieldsValue(metaclass=_BitFieldsMeta):
+    __slots__ = ("_val",)
 
+    def __init__(self, val, **kwargs):
         self._val = val
         for k, v in kwargs.items():
-            top, bot = getattr(self.__class__, k)
-            mask = (1 << (top - bot + 1)) - 1
-            self._val |= (v & mask) << bot
+            field = self._fields[k]
+            self._val |= (v & field.mask) << field.shift
+
+    @classmethod
+    def from_fields(cls, **kwargs):
+        return cls(0, **kwargs)
 
-    def __getattribute__(self, attrname):
-        if attrname.startswith("_"):
-            return object.__getattribute__(self, attrname)
-        top, bot = getattr(self.__class__, attrname)
-        mask = (1 << (top - bot + 1)) - 1
-        return (self._val >> bot) & mask
+    def to_fields(self):
+        return {name: (self._val >> field.shift) & field.mask
+                for name, field in self._fields.items()}
 
     def __str__(self):
-        return ", ".join([f"{n}={getattr(self, n):x}" for n \
-                          in self._fieldnames])
+        return ", ".join([f"{n}={v:x}" for n, v \
+                          in self.to_fields().items()])
 
     def __int__(self):
         return self._val
@@ -108,3 +143,107 @@ class Opcode(IntEnum):
     MULT31 = 0x2e0
     # ...
     MULT0  = 0x2ff
+
+class SideEffect(IntEnum):
+    NONE       = 0
+    PORT_READ  = 1 # takes from or peeks into a port
+    PORT_WRITE = 2 # puts into or updates a port
+    UNKNOWN    = 3
+
+class OpcodeInfo:
+    '''
+    Static properties of an opcode:
+
+     * latency: number of cycles after which the result can be consumed,
+       'spacing' is the number of instruction slots this implies between
+       the instruction and a consumer of its result
+
+     * side_effects: a SideEffect class
+
+     * float_ops: per operand slot, whether the operand is floating-point
+
+     * sieve: which operand slots the DSL fills in, None for all of them
+    '''
+    __slots__ = ("opcode", "latency", "side_effects", "float_ops", "sieve")
+
+    def __init__(self, opcode, latency=1, side_effects=SideEffect.NONE,
+                 float_ops=(False, False, False), sieve=None):
+        self.opcode = opcode
+        self.latency = latency
+        self.side_effects = side_effects
+        self.float_ops = float_ops
+        self.sieve = sieve
+
+    @property
+    def spacing(self):
+        return self.latency - 1
+
+    @property
+    def has_side_effects(self):
+        return self.side_effects != SideEffect.NONE
+
+def _opcode_table():
+    latency = {
+        Opcode.FMULTSUB: 2,
+        Opcode.FMULTACC: 2,
+        Opcode.FMULTACC_NEG: 2,
+    }
+
+    side_effects = {
+        Opcode.TAKE:   SideEffect.PORT_READ,
+        Opcode.TAKEC:  SideEffect.PORT_READ,
+        Opcode.PEEK:   SideEffect.PORT_READ,
+        Opcode.PUT:    SideEffect.PORT_WRITE,
+        Opcode.PUTC:   SideEffect.PORT_WRITE,
+        Opcode.UPDATE: SideEffect.PORT_WRITE,
+        Opcode.UNK_bf: SideEffect.UNKNOWN,
+    }
+
+    float_ops = {
+        opcode: (True, True, True) for opcode in [
+            Opcode.FCMP, Opcode.FCMP2,
+            Opcode.FADD, Opcode.FADD_ABS, Opcode.FADD_DIV2,
+            Opcode.FSUB, Opcode.FSUB_ABS, Opcode.FSUB_DIV2,
+            Opcode.FMULT, Opcode.FMULTACC, Opcode.FMULT_NEG,
+            Opcode.FMULTACC_NEG, Opcode.FMULTSUB,
+        ]
+    }
+    float_ops.update({
+        # selects on the top bit of a fixed-point op3
+        Opcode.FMUX:     (True, True, False),
+        # converts from fixed-point
+        Opcode.F32_FMT:  (False, False, False),
+        # fixed-point fractional multiply, despite the name
+        Opcode.FRACMULT: (False, False, False),
+    })
+
+    # For some operations we adjust the operand mapping in the DSL to make
+    # it more convenient (and save the user from having to pass in dummy
+    # operands to reach desired operand slots).
+    sieve = {
+        Opcode.TAKE:   (False, False, True),
+        Opcode.TAKEC:  (False, True, True),
+        Opcode.PEEK:   (False, False, True),
+        Opcode.PUT:    (True, False, True),
+        Opcode.PUTC:   (True, True, True),
+        Opcode.UPDATE: (True, False, True),
+        Opcode.F32_FMT: (False, True, True),
+        Opcode.FMULT:   (False, True, True),
+        Opcode.FMULT_NEG: (False, True, True),
+
+        Opcode.MULT0:  (False, True, True)
+    }
+
+    return {
+        opcode: OpcodeInfo(
+            opcode,
+            latency=latency.get(opcode, 1),
+            side_effects=side_effects.get(opcode, SideEffect.NONE),
+            float_ops=float_ops.get(opcode, (False, False, False)),
+            sieve=sieve.get(opcode),
+        )
+        for opcode in Opcode
+    }
+
+# Indexed by Opcode (or the plain opcode number)
+OPCODE_INFO = _opcode_table()